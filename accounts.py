@@ -0,0 +1,66 @@
+from typing import Dict, List, Tuple
+import hashlib
+import json
+
+
+# DART accounts loaded into Corp fields.
+# Accounts are matched by IFRS/DART code or by normalized name (only Korean letters and parentheses),
+# listed from the highest priority. When a corporation reports several of them in a file, the
+# account with the highest priority is used. A new row becomes a new column of halq.db.
+taxonomy = [
+    # field               statements      default  codes and names
+    ('sales',             ['PL', 'CPL'],  None,    ['ifrs-full_Revenue', 'ifrs_Revenue', '매출액', '수익(매출액)', '매출']),
+    ('sales_cost',        ['PL', 'CPL'],  None,    ['ifrs-full_CostOfSales', 'ifrs_CostOfSales', '매출원가']),
+    ('net_income',        ['PL', 'CPL'],  None,    ['ifrs-full_ProfitLoss', 'ifrs_ProfitLoss', '당기순이익(손실)', '당기순이익', '분기순이익(손실)', '분기순이익']),
+    ('profit',            ['PL', 'CPL'],  None,    ['dart_OperatingIncomeLoss', '영업이익(손실)', '영업이익', '영업손실']),
+    ('interest_expense',  ['PL', 'CPL'],  None,    ['ifrs-full_InterestExpense', 'dart_InterestExpenseFinanceExpense', 'ifrs_InterestExpense', '이자비용']),
+    ('cash_flow',         ['CF'],         None,    ['ifrs-full_CashFlowsFromUsedInOperatingActivities', 'ifrs_CashFlowsFromUsedInOperatingActivities', '영업활동현금흐름', '영업활동으로인한현금흐름']),
+    ('depreciation',      ['CF'],         None,    ['ifrs-full_AdjustmentsForDepreciationExpense', 'ifrs_AdjustmentsForDepreciationExpense', '감가상각비']),
+    ('capex_intangible',  ['CF'],         0,       ['ifrs-full_PurchaseOfIntangibleAssetsClassifiedAsInvestingActivities', 'ifrs_PurchaseOfIntangibleAssetsClassifiedAsInvestingActivities', '무형자산의취득']),
+    ('capex_property',    ['CF'],         0,       ['ifrs-full_PurchaseOfPropertyPlantAndEquipmentClassifiedAsInvestingActivities', 'ifrs_PurchaseOfPropertyPlantAndEquipmentClassifiedAsInvestingActivities', '유형자산의취득']),
+    ('assets',            ['BS'],         None,    ['ifrs-full_Assets', 'ifrs_Assets', '자산총계']),
+    ('equity',            ['BS'],         None,    ['ifrs-full_Equity', 'ifrs_Equity', '자본총계']),
+    ('liabilities',       ['BS'],         None,    ['ifrs-full_Liabilities', 'ifrs_Liabilities', '부채총계']),
+    ('inventories',       ['BS'],         None,    ['ifrs-full_Inventories', 'ifrs_Inventories', '재고자산']),
+    ('equity_issue',      ['CE'],         0,       ['ifrs-full_IssueOfEquity', 'ifrs_IssueOfEquity']),
+]
+
+statements = ['PL', 'CPL', 'CF', 'BS', 'CE']
+
+# Amounts of other periods read from the same rows of a DART file, loaded as {field}_{period} fields.
+#   ytd        year-to-date cumulative amount
+#   prior      same period of the previous year as the current amount
+#   prior_ytd  year-to-date cumulative amount of the previous year
+#   prior_fy   previous fiscal year, its year-end balance for BS
+_flow_periods = ['ytd', 'prior', 'prior_ytd', 'prior_fy']
+periods: Dict[str, List[str]] = {
+    'PL':  _flow_periods,
+    'CPL': _flow_periods,
+    'CF':  _flow_periods,
+    'BS':  ['prior_fy'],
+    'CE':  [],
+}
+
+
+def _compile(statement: str) -> Dict[str, Tuple[str, int]]:
+    # code or name -> (field, priority), 0 is the highest priority
+    lookup = {}
+    for field, types, _, keys in taxonomy:
+        if statement not in types:
+            continue
+        for priority, key in enumerate(keys):
+            if key in lookup:
+                raise ValueError(f'{key} is mapped to both {lookup[key][0]} and {field}')
+            lookup[key] = (field, priority)
+    return lookup
+
+
+lookups: Dict[str, Dict[str, Tuple[str, int]]] = {s: _compile(s) for s in statements}
+
+fields: List[str] = [a[0] for a in taxonomy]
+defaults: Dict[str, int] = {a[0]: a[2] for a in taxonomy if a[2] is not None}
+period_fields: List[str] = [f'{a[0]}_{p}' for a in taxonomy for p in periods[a[1][0]]]
+
+# Digest of the mapping above. Parsed quarters (krx cache) and built quarters (build_quarters) made with
+# another mapping are parsed again.
+digest: str = hashlib.sha1(json.dumps([taxonomy, periods], ensure_ascii=False).encode('utf-8')).hexdigest()
@@ -0,0 +1,121 @@
+from typing import Dict, IO, Tuple
+import hashlib
+import os, re, zipfile
+
+
+# DART bulk downloads are zip files of EUC-KR text files named like
+# 2021_1분기보고서_03_포괄손익계산서_연결_20210603.txt
+reports = {
+    '1분기보고서': 1,
+    '반기보고서':  2,
+    '3분기보고서': 3,
+    '사업보고서':  4,
+}
+
+# 포괄손익계산서 contains 손익계산서 and is matched first
+statements = {
+    '현금흐름표'   : 'CF',
+    '포괄손익계산서': 'CPL',
+    '손익계산서'   : 'PL',
+    '재무상태표'   : 'BS',
+    '자본변동표'   : 'CE',
+}
+
+# CP949 is a superset of EUC-KR, some corporation names use its extra characters
+encoding = 'cp949'
+
+
+def parse_name(name: str) -> Tuple[int, int, str, bool]:
+    # (year, quarter, type, consolidated) of an original DART filename, None if it is not a statement
+    base = os.path.basename(name)
+    m = re.match(r'(\d{4})', base)
+    if m is None:
+        return None
+    quarter = next((v for k, v in reports.items() if k in base), None)
+    type = next((v for k, v in statements.items() if k in base), None)
+    if quarter is None or type is None:
+        return None
+    return int(m.group(1)), quarter, type, '연결' in base
+
+
+def filename(year: int, quarter: int, type: str, con: bool) -> str:
+    # Name of the converted file in dart-data, also krx.get_filename
+    return f'{year}-{quarter}Q-{type}{"-c" if con else ""}.txt'
+
+
+def _member_name(info: zipfile.ZipInfo) -> str:
+    # Names without the UTF-8 flag are decoded as CP437 by zipfile, but are CP949 in DART archives
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode('cp437').decode(encoding)
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+
+# zip path -> ((size, mtime_ns), {filename: ZipInfo})
+_archives: Dict[str, Tuple[tuple, Dict[str, zipfile.ZipInfo]]] = {}
+
+
+def scan_zip(path: str) -> Dict[str, zipfile.ZipInfo]:
+    st = os.stat(path)
+    key = (st.st_size, st.st_mtime_ns)
+    cached = _archives.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    members = {}
+    try:
+        with zipfile.ZipFile(path) as zf:
+            # Later downloads of the same statement (greater date suffix) win
+            for info in sorted(zf.infolist(), key=_member_name):
+                name = _member_name(info)
+                parsed = parse_name(name) if name.endswith('.txt') else None
+                if parsed is not None:
+                    members[filename(*parsed)] = info
+    except zipfile.BadZipFile as e:
+        print(f'Invalid archive {path}: {e}')
+    _archives[path] = (key, members)
+    return members
+
+
+def members(dir: str) -> Dict[str, Tuple[str, zipfile.ZipInfo]]:
+    # filename -> (zip path, member) of every statement in the archives of dir
+    ret = {}
+    if not os.path.isdir(dir):
+        return ret
+    for f in sorted(os.listdir(dir)):
+        if f.lower().endswith('.zip'):
+            path = os.path.join(dir, f)
+            for name, info in scan_zip(path).items():
+                ret[name] = (path, info)
+    return ret
+
+
+def open_binary(dir: str, name: str) -> Tuple[IO[bytes], str]:
+    # Stream of a converted UTF-8 file or of an archived EUC-KR file, decompressed while read, and its encoding
+    path = os.path.join(dir, name)
+    if os.path.exists(path):
+        return open(path, 'rb'), 'utf-8'
+    zip, info = members(dir)[name]
+    with zipfile.ZipFile(zip) as zf:
+        # The member keeps the archive file open after zf is closed
+        return zf.open(info), encoding
+
+
+def file_hash(path: str) -> str:
+    # sha1 of a file, read a chunk at a time
+    h = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def decode(data: bytes) -> str:
+    # Files downloaded from KRX are EUC-KR unless converted
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode(encoding)
+
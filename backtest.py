@@ -0,0 +1,211 @@
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+import multiprocessing
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import panel
+import schema
+
+
+# Backtests of rank-based strategies over the dense panel of halq.db (see panel.Panel).
+# Each rebalance buys the `top` eligible stocks with the lowest sum of the rank columns (1 is the best rank),
+# equally weighted, at the prices of that quarter's Stocks.csv and holds them for `hold` quarters.
+# Strategies sharing rank columns and filters share one sort per quarter, and the returns of every portfolio
+# size are read from cumulative sums over that order, so thousands of parameterizations cost little more than
+# one. Stocks without a price at the end of a holding period (delisted, suspended) are left out of the average.
+#
+#   backtest.run([backtest.Strategy(('ord_iper', 'ord_ipbr'), top=n, hold=h) for n in (10, 20, 30) for h in (1, 2, 4)])
+_sqlite_filename = schema.sqlite_filename
+_table_name = schema.table_name
+
+market_codes = {'KOSPI': 1, 'KOSDAQ': 2}
+
+
+class Strategy(NamedTuple):
+    ranks: Tuple[str, ...]      # rank columns summed into the score, the lowest scores are bought
+    top: int = 30               # stocks held, equally weighted
+    hold: int = 1               # quarters between rebalances
+    min_fscore: int = 0         # only stocks with fscore_k >= min_fscore
+    market: str = None          # only 'KOSPI' or 'KOSDAQ' stocks
+
+
+result_columns = ['ranks', 'top', 'hold', 'min_fscore', 'market', 'periods', 'total_return', 'cagr', 'mean_return',
+                  'volatility', 'sharpe', 'max_drawdown', 'turnover']
+
+
+class Backtest:
+    def __init__(self, p: panel.Panel, markets: np.ndarray, begin: Tuple[int, int] = None, end: Tuple[int, int] = None):
+        # markets: stock x quarter codes of market_codes, 0 where the stock is not listed
+        if len(p.quarters) == 0:
+            raise ValueError('The panel has no quarters')
+        first = 0 if begin is None else next((i for i, t in enumerate(p.quarters) if t >= begin), None)
+        last = len(p.quarters) if end is None else max((i for i, t in enumerate(p.quarters) if t <= end), default=-1) + 1
+        if first is None or first >= last:
+            raise ValueError(f'No quarter of the panel ({p.quarters[0]} to {p.quarters[-1]}) between {begin} and {end}')
+        self.panel = p
+        self.quarters = p.quarters[first:last]
+        self._columns = slice(first, last)
+        self.markets = markets[:, self._columns]
+        self.price = self.field('price')
+        self._returns: Dict[int, np.ndarray] = {}
+
+    def field(self, name: str) -> np.ndarray:
+        return np.asarray(self.panel.field(name)[:, self._columns], dtype=np.float64)
+
+    def returns(self, hold: int) -> np.ndarray:
+        # Price return of each stock bought in a quarter and sold hold quarters later, NaN without both prices
+        if hold not in self._returns:
+            r = np.full(self.price.shape, np.nan)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r[:, :-hold] = self.price[:, hold:] / self.price[:, :-hold] - 1
+            r[~np.isfinite(r)] = np.nan
+            self._returns[hold] = r
+        return self._returns[hold]
+
+    def _order(self, ranks: Tuple[str, ...], min_fscore: int, market: str) -> Tuple[np.ndarray, np.ndarray]:
+        # Stocks of each quarter by score (ties by stock code) and the number of eligible ones
+        score = schema.score(ranks, self.field)
+        eligible = ~np.isnan(score) & ~np.isnan(self.price)
+        if min_fscore > 0:
+            with np.errstate(invalid='ignore'):
+                eligible &= self.field('fscore_k') >= min_fscore
+        eligible &= self.markets > 0 if market is None else self.markets == market_codes[market]
+        order = np.argsort(np.where(eligible, score, np.inf), axis=0, kind='stable')
+        return order, eligible.sum(axis=0)
+
+    def _group(self, strategies: List[Tuple[int, Strategy]]) -> List[Tuple[int, Dict]]:
+        # (index, strategy) with the same ranks and filters -> (index, summary)
+        s0 = strategies[0][1]
+        order, count = self._order(s0.ranks, s0.min_fscore, s0.market)
+        n = order.shape[0]
+        position = np.empty_like(order)
+        np.put_along_axis(position, order, np.broadcast_to(np.arange(n)[:, None], order.shape), axis=0)
+
+        ret = []
+        for hold in sorted(set(s.hold for _, s in strategies)):
+            r = np.take_along_axis(self.returns(hold), order, axis=0)
+            valid = ~np.isnan(r) & (np.arange(n)[:, None] < count[None, :])
+            # Sum and number of returns of the first i + 1 stocks of each quarter
+            total = np.cumsum(np.where(valid, r, 0), axis=0)
+            held = np.cumsum(valid, axis=0)
+            rebalances = np.arange(0, len(self.quarters) - hold, hold)
+            for k, s in ((k, s) for k, s in strategies if s.hold == hold):
+                i = min(s.top, n) - 1
+                with np.errstate(invalid='ignore'):
+                    period = total[i, rebalances] / held[i, rebalances]
+                # Cash when nothing is held
+                period = np.where(np.isnan(period), 0.0, period)
+                holdings = position[:, rebalances] < np.minimum(s.top, count[rebalances])
+                ret.append((k, _summary(s, period, holdings, hold)))
+        return ret
+
+    def summaries(self, strategies: List[Tuple[int, Strategy]]) -> List[Tuple[int, Dict]]:
+        for _, s in strategies:
+            _check(s)
+        return [r for g in _groups(strategies).values() for r in self._group(g)]
+
+    def run(self, strategies: Sequence[Strategy]) -> pd.DataFrame:
+        rows = sorted(self.summaries(list(enumerate(strategies))), key=lambda r: r[0])
+        return pd.DataFrame([r for _, r in rows], columns=result_columns)
+
+    def series(self, strategy: Strategy) -> pd.Series:
+        # Returns of each holding period of one strategy, indexed by the quarter bought
+        _check(strategy)
+        order, count = self._order(tuple(strategy.ranks), strategy.min_fscore, strategy.market)
+        r = np.take_along_axis(self.returns(strategy.hold), order, axis=0)
+        rebalances = np.arange(0, len(self.quarters) - strategy.hold, strategy.hold)
+        period = []
+        for t in rebalances:
+            top = r[:min(strategy.top, count[t]), t]
+            top = top[~np.isnan(top)]
+            period.append(top.mean() if len(top) > 0 else 0.0)
+        return pd.Series(period, index=pd.MultiIndex.from_tuples([self.quarters[t] for t in rebalances], names=['year', 'quarter']))
+
+
+def _check(s: Strategy) -> None:
+    if s.hold <= 0:
+        raise ValueError(f'hold must be positive: {s.hold}')
+    if s.top <= 0:
+        raise ValueError(f'top must be positive: {s.top}')
+
+
+def _groups(strategies: List[Tuple[int, Strategy]]) -> Dict[tuple, List[Tuple[int, Strategy]]]:
+    # Strategies sharing their ranks and filters, and so the order of stocks
+    groups = {}
+    for k, s in strategies:
+        groups.setdefault((tuple(s.ranks), s.min_fscore, s.market), []).append((k, s))
+    return groups
+
+
+def _summary(s: Strategy, period: np.ndarray, holdings: np.ndarray, hold: int) -> Dict:
+    value = np.cumprod(1 + period)
+    total = value[-1] - 1 if len(value) > 0 else 0.0
+    years = len(period) * hold / 4
+    std = period.std(ddof=1) if len(period) > 1 else np.nan
+    drawdown = 1 - value / np.maximum.accumulate(np.r_[1.0, value])[1:] if len(value) > 0 else np.zeros(1)
+    # Share of the portfolio replaced at each rebalance
+    size = holdings.sum(axis=0)
+    kept = (holdings[:, 1:] & holdings[:, :-1]).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        turnover = np.nanmean(1 - kept / size[1:]) if holdings.shape[1] > 1 else np.nan
+    return {
+        'ranks': '+'.join(s.ranks), 'top': s.top, 'hold': hold, 'min_fscore': s.min_fscore, 'market': s.market,
+        'periods': len(period),
+        'total_return': total,
+        'cagr': (1 + total) ** (1 / years) - 1 if years > 0 and total > -1 else np.nan,
+        'mean_return': period.mean() if len(period) > 0 else np.nan,
+        'volatility': std,
+        'sharpe': period.mean() / std * np.sqrt(4 / hold) if std > 0 else np.nan,
+        'max_drawdown': drawdown.max(),
+        'turnover': turnover,
+    }
+
+
+def _markets(conn: sqlite3.Connection, p: panel.Panel) -> np.ndarray:
+    # Market of each stock and quarter, from the text column not held by the panel
+    df = pd.read_sql_query(f'SELECT stock, year, quarter, market FROM {_table_name}', conn)
+    markets = np.zeros((len(p.stocks), len(p.quarters)), dtype=np.int8)
+    row = df['stock'].map(p.stock_index).to_numpy()
+    col = pd.Series(list(zip(df['year'], df['quarter']))).map(p.quarter_index).to_numpy()
+    markets[row, col] = df['market'].map(market_codes).fillna(0).to_numpy(dtype=np.int8)
+    return markets
+
+
+def load(filename: str = _sqlite_filename, path: str = panel._panel_dir) -> Tuple[panel.Panel, np.ndarray]:
+    # The panel of halq.db, rebuilt if stale, and the market matrix
+    conn = sqlite3.connect(filename)
+    try:
+        p = panel.load(path) if panel.up_to_date(conn, path) else panel.build(conn, path)
+        return p, _markets(conn, p)
+    finally:
+        conn.close()
+
+
+def _run_chunk(args: tuple) -> List[Tuple[int, Dict]]:
+    # In a worker: the panel file is mapped again, its pages are shared with the other processes.
+    # It must be the panel the markets were derived from, not one rebuilt since.
+    path, signature, markets, begin, end, strategies = args
+    p = panel.load(path)
+    if p is None or p.signature != signature:
+        raise RuntimeError(f'{path} was rebuilt during the backtest')
+    return Backtest(p, markets, begin, end).summaries(strategies)
+
+
+def run(strategies: Sequence[Strategy], begin: Tuple[int, int] = None, end: Tuple[int, int] = None, workers: int = 1,
+        filename: str = _sqlite_filename, path: str = panel._panel_dir) -> pd.DataFrame:
+    # Summary of each strategy, in the order given. workers > 1 spreads groups of strategies sharing
+    # their ranks and filters over a process pool.
+    p, markets = load(filename, path)
+    if workers <= 1:
+        return Backtest(p, markets, begin, end).run(strategies)
+
+    groups = list(_groups(list(enumerate(strategies))).values())
+    chunks = [[] for _ in range(min(workers, len(groups)))]
+    for i, g in enumerate(groups):
+        chunks[i % len(chunks)].extend(g)
+    with multiprocessing.Pool(len(chunks)) as pool:
+        rows = [r for c in pool.map(_run_chunk, [(path, p.signature, markets, begin, end, c) for c in chunks]) for r in c]
+    rows.sort(key=lambda r: r[0])
+    return pd.DataFrame([r for _, r in rows], columns=result_columns)
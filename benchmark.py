@@ -0,0 +1,358 @@
+from typing import Dict, List, Tuple
+import argparse
+import json
+import os, sys
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+
+import accounts
+import catalog
+import convert_sqlite
+import ingest
+import krx
+
+# Benchmark of the DART pipeline on synthetic data.
+# Writes dart-data/ into a scratch directory, times the krx loaders, load_dart_data, the prep stages and the
+# indicator/ranking SQL, and reports seconds, rows/sec and peak memory of each as JSON.
+#
+#   python benchmark.py --corps 2000 --begin 2016 1 --end 2020 4 --output new.json --compare old.json
+
+
+# Header of the amount columns, by statement type and quarter
+_report_names = {1: '1분기', 2: '반기', 3: '3분기', 4: ''}
+_markets = ['유가증권시장상장법인', '코스닥시장상장법인', '코넥스시장상장법인']
+_krx_markets = {'유가증권시장상장법인': 'KOSPI', '코스닥시장상장법인': 'KOSDAQ', '코넥스시장상장법인': 'KONEX'}
+
+
+def _amount_headers(type: str, quarter: int) -> List[str]:
+    q = _report_names[quarter]
+    if type in ('PL', 'CPL') and quarter != 4:
+        return [f'당기 {q} 3개월', f'당기 {q} 누적', f'전기 {q} 3개월', f'전기 {q} 누적', '전기', '전전기']
+    if type == 'BS':
+        return [f'당기 {q}말' if quarter != 4 else '당기', '전기말', '전전기말']
+    if type == 'CF':
+        return [f'당기 {q}', f'전기 {q}', '전기', '전전기'] if quarter != 4 else ['당기', '전기', '전전기']
+    return ['당기', '전기', '전전기']
+
+
+def _format(rng: random.Random, v: int) -> str:
+    return f'{v:,}' if rng.random() < 0.5 else str(v)
+
+
+def generate(dir: str, corps: int = 2000, begin: Tuple[int, int] = (2016, 1), end: Tuple[int, int] = (2017, 4),
+             extra_accounts: int = 20, shifted: float = 0.3, invalid: float = 0.001, empty: float = 0.02, seed: int = 1) -> Dict:
+    # Writes {dir}/dart-data with the statements of every quarter in [begin, end] and a Stocks.csv per quarter.
+    # corps: listed corporations, about 1/3 of them on KOSDAQ and a few on KONEX
+    # extra_accounts: accounts per statement not in accounts.taxonomy
+    # shifted: share of files with an empty header column before the amounts (value column 13 instead of 12)
+    # invalid, empty: share of malformed and empty amounts
+    rng = random.Random(seed)
+    data = os.path.join(dir, 'dart-data')
+    os.makedirs(data, exist_ok=True)
+
+    stocks = [f'{(i * 37) % 999983:06d}' for i in range(corps)]
+    markets = [_markets[2] if i % 97 == 5 else _markets[1] if i % 3 == 0 else _markets[0] for i in range(corps)]
+    names = [f'회사{i}' for i in range(corps)]
+
+    # (code, name) of the accounts of each statement, the first code and name of every field in accounts.taxonomy
+    rows = {t: [] for t in accounts.statements}
+    for field, types, _, keys in accounts.taxonomy:
+        codes = [k for k in keys if k.isascii()]
+        labels = [k for k in keys if not k.isascii()]
+        for t in types:
+            rows[t].append((codes[0] if codes else '-표준계정코드 미사용-', ' ' + (labels[0] if labels else field) + ' '))
+    for t in rows:
+        rows[t] += [(f'dart_Other{j}', f' 기타계정{j} ') for j in range(extra_accounts)]
+
+    files = lines_total = 0
+    year, quarter = begin
+    while (year, quarter) <= end:
+        for t in accounts.statements:
+            for con in (False, True):
+                shift = t != 'CE' and rng.random() < shifted
+                header = ['재무제표종류', '종목코드', '회사명', '시장구분', '업종', '업종명', '결산월', '결산기준일', '보고서종류', '통화', '항목코드', '항목명']
+                header += [''] if shift else []
+                header += _amount_headers(t, quarter)
+                lines = ['\t'.join(header)]
+                for i in range(corps):
+                    # Corporations report either PL or CPL, and either consolidated or not
+                    if t in ('PL', 'CPL') and (t == 'PL') != (i % 2 == 0):
+                        continue
+                    if con != (i % 4 < 2) or (i + year + quarter) % 23 == 0:
+                        continue
+                    base = (i % 500 + 1) * 1000000
+                    for code, name in rows[t]:
+                        values = [_format(rng, rng.randint(-base, base * 5)) for _ in header[12 + shift:]]
+                        r = rng.random()
+                        if r < empty:
+                            values[0] = ''
+                        elif r < empty + invalid:
+                            values[0] = '1,2a3'
+                        line = ['재무제표', f'[{stocks[i]}]', names[i], markets[i], '264', '업종', '12', f'{year}-{quarter * 3:02d}-30', '보고서', 'KRW', code, name]
+                        line += [''] if shift else []
+                        lines.append('\t'.join(line + values) + '\t')
+                with open(os.path.join(data, krx.get_filename(year, quarter, t, con)), 'w', encoding='utf-8') as fout:
+                    fout.write('\n'.join(lines) + '\n')
+                files += 1
+                lines_total += len(lines) - 1
+
+        with open(os.path.join(data, f'{year}-{quarter}Q-Stocks.csv'), 'w', encoding='utf-8') as fout:
+            fout.write('"종목코드","종목명","시장구분","소속부","종가","대비","등락률","시가","고가","저가","거래량","거래대금","시가총액","상장주식수"\n')
+            for i in range(corps):
+                price = 1000 + (i * 37 + year + quarter) % 90000
+                shares = 100000 + i * 1000
+                fout.write(f'"{stocks[i]}","{names[i]}","{_krx_markets[markets[i]]}","","{price}","0","0.0","1","1","1","1","1","{price * shares}","{shares}"\n')
+        files += 1
+
+        quarter += 1
+        if quarter == 5:
+            year, quarter = year + 1, 1
+    return {'files': files, 'rows': lines_total}
+
+
+class _MemorySampler(threading.Thread):
+    # Peak RSS of this process, sampled from /proc/self/statm. Worker processes are not included.
+    def __init__(self, interval: float = 0.002):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.page = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        self.available = os.path.exists('/proc/self/statm')
+        self.peak = self.start_rss = self.rss()
+        self.running = True
+
+    def rss(self) -> int:
+        if not self.available:
+            # Lifetime maximum, in KB on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        with open('/proc/self/statm', 'r') as fin:
+            return int(fin.read().split()[1]) * self.page
+
+    def reset(self) -> None:
+        self.peak = self.start_rss = self.rss()
+
+    def run(self) -> None:
+        while self.running:
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+
+class Benchmark:
+    def __init__(self, repeat: int = 1):
+        self.repeat = repeat
+        self.results: List[Dict] = []
+        self.memory = _MemorySampler()
+        self.memory.start()
+
+    def run(self, name: str, fn, rows: int = None, setup=None):
+        # Best wall time of repeat runs, rows is the number of rows processed by one run.
+        # setup(), untimed, brings back the state of the first run before each one (an empty table or cache).
+        best = None
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            self.memory.reset()
+            cpu = time.process_time()
+            start = time.perf_counter()
+            ret = fn()
+            seconds = time.perf_counter() - start
+            cpu = time.process_time() - cpu
+            self.memory.peak = max(self.memory.peak, self.memory.rss())
+            if best is None or seconds < best['seconds']:
+                best = {'name': name, 'seconds': round(seconds, 6), 'cpu_seconds': round(cpu, 6),
+                        'peak_rss_bytes': self.memory.peak, 'peak_rss_delta_bytes': self.memory.peak - self.memory.start_rss}
+        if rows is not None:
+            best['rows'] = rows
+            best['rows_per_sec'] = round(rows / best['seconds'], 1) if best['seconds'] > 0 else None
+        self.results.append(best)
+        print(f'{name:45s} {best["seconds"]:9.3f}s' + (f' {best["rows_per_sec"]:>14,.0f} rows/s' if best.get('rows_per_sec') else '') +
+              f' {best["peak_rss_delta_bytes"] / 1048576:9.1f} MB', file=sys.stderr)
+        return ret
+
+
+def _quarters(begin: Tuple[int, int], end: Tuple[int, int]) -> List[Tuple[int, int]]:
+    ret = []
+    year, quarter = begin
+    while (year, quarter) <= end:
+        ret.append((year, quarter))
+        quarter += 1
+        if quarter == 5:
+            year, quarter = year + 1, 1
+    return ret
+
+
+def _count_rows(filename: str) -> int:
+    with open('dart-data/' + filename, 'rb') as fin:
+        return sum(1 for _ in fin) - 1
+
+
+def bench_loaders(b: Benchmark, year: int, quarter: int) -> None:
+    # Each statement file and Stocks.csv of one quarter
+    parsed = {}
+    for t, con in krx.statement_files:
+        filename = krx.get_filename(year, quarter, t, con)
+        parsed[(t, con)] = b.run(f'krx.parse_statement {t}{"-c" if con else ""}', lambda: krx.parse_statement(year, quarter, t, con), _count_rows(filename))
+    shares = b.run('krx.parse_shares', lambda: krx.parse_shares(year, quarter), _count_rows(f'{year}-{quarter}Q-Stocks.csv'))
+
+    def merge():
+        corps = krx.CorpBatch(year, quarter)
+        for t, con in krx.statement_files:
+            krx.merge_statement(corps, t, parsed[(t, con)])
+        krx.merge_shares(corps, shares)
+        return corps
+    corps = b.run('krx.merge_statement+merge_shares', merge, sum(len(p[1]) for p in parsed.values()))
+
+    rows = sum(_count_rows(krx.get_filename(year, quarter, t, con)) for t, con in krx.statement_files)
+    b.run('krx.load_dart_data (no cache)', lambda: krx.load_dart_data(year, quarter, use_cache=False), rows)
+    b.run('krx.load_dart_data (write cache)', lambda: krx.load_dart_data(year, quarter), rows, setup=lambda: krx.purge_cache(year, quarter))
+    b.run('krx.load_dart_data (cached)', lambda: krx.load_dart_data(year, quarter), len(corps))
+
+
+def _remove(filename: str) -> None:
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def bench_prep(b: Benchmark, tlist: List[Tuple[int, int]], workers: int) -> None:
+    # prep stage by stage on a new database, then prep itself
+    _remove(convert_sqlite._sqlite_filename)
+    entries = b.run('catalog.scan (hashing)', catalog.scan, setup=lambda: _remove(catalog._catalog_filename))
+    b.run('catalog.scan (persisted)', catalog.scan, len(entries))
+
+    rows = sum(_count_rows(f) for t in tlist for f in catalog.source_files(*t))
+    batches = b.run('ingest.load_quarters (parse)', lambda: list(ingest.load_quarters(tlist, workers)), rows, setup=krx.purge_cache)
+    corps = sum(len(c) for c in batches)
+    b.run('ingest.load_quarters (cached)', lambda: list(ingest.load_quarters(tlist, workers)), corps)
+    frames = b.run('CorpBatch.to_frame', lambda: [c.to_frame() for c in batches], corps)
+    frames = b.run('simple indicators', lambda: [convert_sqlite._simple_indicators(df) for df in frames], corps)
+
+    conn = sqlite3.connect(convert_sqlite._sqlite_filename)
+    for pragma in convert_sqlite._bulk_pragmas:
+        conn.execute(pragma)
+    cur = conn.cursor()
+    table = convert_sqlite._table_name
+
+    def quality():
+        for c in batches:
+            convert_sqlite._replace_quality(cur, c.year, c.quarter, c.quality(), c.completeness())
+    b.run('quality tables', quality, corps)
+    b.run('aggregates', lambda: sum(convert_sqlite._replace_aggregates(cur, df['year'].iloc[0], df['quarter'].iloc[0], df) for df in frames), corps)
+
+    def new_table():
+        cur.execute(f'DROP TABLE IF EXISTS {table}')
+        convert_sqlite._create_table(cur, list(frames[0].columns))
+
+    def insert():
+        for df in frames:
+            convert_sqlite._insert(cur, df)
+        conn.commit()
+    b.run('insert (executemany)', insert, corps, setup=new_table)
+    b.run('index build', lambda: cur.execute(f'CREATE UNIQUE INDEX index_key on {table}(year, quarter, stock)'), corps,
+          setup=lambda: cur.execute('DROP INDEX IF EXISTS index_key'))
+    b.run('panel derivation', lambda: convert_sqlite._derive_panel(cur, tlist), corps)
+    for i, sql in enumerate(convert_sqlite._indicator_sql):
+        b.run(f'indicator sql {i}', lambda: convert_sqlite.calculate_indicators(sql.format(scope=convert_sqlite._all_scope), cur), corps)
+    b.run('rank_corps', lambda: convert_sqlite.rank_corps(cur), corps)
+    for method in ('rank', 'percent'):
+        b.run(f'rank_corps {method} by market', lambda: convert_sqlite.rank_corps(cur, by_market=True, method=method, prefix=f'bench_{method}_'), corps)
+    conn.commit()
+    b.run('ANALYZE', lambda: cur.execute('ANALYZE'))
+    conn.close()
+
+    (by, bq), (ey, eq) = tlist[0], tlist[-1]
+    b.run('prep full (no cache)', lambda: convert_sqlite.prep(by, bq, ey, eq, full=True, workers=workers), corps, setup=krx.purge_cache)
+    b.run('prep full (cached)', lambda: convert_sqlite.prep(by, bq, ey, eq, full=True, workers=workers), corps)
+    b.run('prep up to date', lambda: convert_sqlite.prep(by, bq, ey, eq, workers=workers))
+
+    def touch():
+        # One quarter changed
+        with open('dart-data/' + krx.get_filename(*tlist[len(tlist) // 2], 'BS', False), 'a', encoding='utf-8') as fout:
+            fout.write('\n')
+    b.run('prep incremental (1 quarter)', lambda: convert_sqlite.prep(by, bq, ey, eq, workers=workers), len(batches[len(tlist) // 2]), setup=touch)
+
+
+def _git_version() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(old: Dict, new: Dict) -> None:
+    # Speedup of each benchmark found in both reports
+    before = {r['name']: r for r in old['results']}
+    print(f'{"":45s} {"old":>9s} {"new":>9s} {"speedup":>8s}', file=sys.stderr)
+    for r in new['results']:
+        o = before.get(r['name'])
+        if o is None:
+            continue
+        speedup = o['seconds'] / r['seconds'] if r['seconds'] > 0 else float('inf')
+        print(f'{r["name"]:45s} {o["seconds"]:9.3f} {r["seconds"]:9.3f} {speedup:7.2f}x', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the DART pipeline on synthetic data')
+    parser.add_argument('--corps', type=int, default=2000)
+    parser.add_argument('--begin', type=int, nargs=2, default=[2016, 1], metavar=('YEAR', 'QUARTER'))
+    parser.add_argument('--end', type=int, nargs=2, default=[2017, 4], metavar=('YEAR', 'QUARTER'))
+    parser.add_argument('--accounts', type=int, default=20, help='accounts per statement not in accounts.taxonomy')
+    parser.add_argument('--invalid', type=float, default=0.001, help='share of malformed amounts')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--dir', help='scratch directory, kept after the run (a temporary one is removed)')
+    parser.add_argument('--output', help='JSON report file, stdout by default')
+    parser.add_argument('--compare', help='earlier JSON report to compare with')
+    args = parser.parse_args()
+
+    dir = args.dir or tempfile.mkdtemp(prefix='fin-data-bench-')
+    cwd = os.getcwd()
+    begin, end = tuple(args.begin), tuple(args.end)
+    try:
+        config = {'corps': args.corps, 'begin': begin, 'end': end, 'accounts': args.accounts, 'invalid': args.invalid,
+                  'seed': args.seed, 'workers': args.workers or ingest.default_workers(), 'repeat': args.repeat}
+        print(f'Generating synthetic dart-data in {dir}', file=sys.stderr)
+        generated = generate(dir, args.corps, begin, end, args.accounts, invalid=args.invalid, seed=args.seed)
+        os.chdir(dir)
+
+        # Output of the pipeline itself goes to stderr, the report to stdout
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        b = Benchmark(args.repeat)
+        tlist = _quarters(begin, end)
+        bench_loaders(b, *tlist[0])
+        bench_prep(b, tlist, config['workers'])
+        b.memory.running = False
+        sys.stdout = stdout
+
+        report = {
+            'version': _git_version(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'config': config,
+            'generated': generated,
+            'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'results': b.results,
+        }
+    finally:
+        os.chdir(cwd)
+        if args.dir is None:
+            shutil.rmtree(dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fout:
+            json.dump(report, fout, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as fin:
+            compare(json.load(fin), report)
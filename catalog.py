@@ -0,0 +1,110 @@
+from typing import Dict, List, NamedTuple, Tuple
+import hashlib
+import json
+import os, re
+
+import accounts
+import archive
+
+
+# Catalog of dart-data: every statement and Stocks.csv file, converted or in a zip archive, found in one
+# directory scan. Hashes are persisted and recomputed only for files whose size or mtime changed.
+_data_dir = 'dart-data'
+_catalog_filename = 'dart-cache/catalog.json'
+_catalog_version = 1
+
+_converted = re.compile(r'(\d{4})-(\d)Q-(?:(PL|CPL|CF|BS|CE)(-c)?\.txt|Stocks\.csv)')
+
+
+class Entry(NamedTuple):
+    size: int
+    mtime_ns: int
+    hash: str       # sha1 of a converted file, crc32 of an archived one
+    zip: str        # archive path, None for a converted file
+
+
+def _load(filename: str) -> Dict[str, Entry]:
+    try:
+        with open(filename, 'r', encoding='utf-8') as fin:
+            saved = json.load(fin)
+        if saved.get('version') != _catalog_version:
+            return {}
+        return {name: Entry(*e) for name, e in saved['files'].items()}
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def _save(filename: str, entries: Dict[str, Entry]) -> None:
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + '.tmp', 'w', encoding='utf-8') as fout:
+        json.dump({'version': _catalog_version, 'files': {name: list(e) for name, e in sorted(entries.items())}}, fout, ensure_ascii=False, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def scan(dir: str = _data_dir, filename: str = _catalog_filename) -> Dict[str, Entry]:
+    # filename -> Entry, converted files take precedence over archived ones as in archive.open_binary
+    if not os.path.isdir(dir):
+        return {}
+    known = _load(filename)
+    entries = {}
+    zips = []
+    with os.scandir(dir) as it:
+        for e in it:
+            if _converted.fullmatch(e.name):
+                st = e.stat()
+                k = known.get(e.name)
+                if k is not None and k.zip is None and k.size == st.st_size and k.mtime_ns == st.st_mtime_ns:
+                    entries[e.name] = k
+                else:
+                    entries[e.name] = Entry(st.st_size, st.st_mtime_ns, archive.file_hash(e.path), None)
+            elif e.name.lower().endswith('.zip'):
+                zips.append(e)
+
+    # Later archives win as in archive.members
+    archived = {}
+    for e in sorted(zips, key=lambda e: e.name):
+        mtime = e.stat().st_mtime_ns
+        for name, info in archive.scan_zip(e.path).items():
+            archived[name] = Entry(info.file_size, mtime, f'crc32:{info.CRC:08x}', e.path)
+    for name, entry in archived.items():
+        entries.setdefault(name, entry)
+
+    if entries != known:
+        _save(filename, entries)
+    return entries
+
+
+def statement_files(year: int, quarter: int) -> List[str]:
+    return [archive.filename(year, quarter, t, con) for t in accounts.statements for con in (False, True)]
+
+
+def source_files(year: int, quarter: int) -> List[str]:
+    return statement_files(year, quarter) + [f'{year}-{quarter}Q-Stocks.csv']
+
+
+def complete(entries: Dict[str, Entry], year: int, quarter: int) -> bool:
+    # Every statement of the quarter is available
+    return all(f in entries for f in statement_files(year, quarter))
+
+
+def quarters(entries: Dict[str, Entry]) -> List[Tuple[int, int]]:
+    # Complete quarters, in order
+    found = set()
+    for name in entries:
+        m = _converted.fullmatch(name)
+        found.add((int(m.group(1)), int(m.group(2))))
+    return sorted(t for t in found if complete(entries, *t))
+
+
+def signature(entries: Dict[str, Entry], year: int, quarter: int) -> Dict[str, tuple]:
+    # name -> (size, mtime_ns, hash) of the quarter's source files that exist
+    return {f: tuple(entries[f][:3]) for f in source_files(year, quarter) if f in entries}
+
+
+def digest(entries: Dict[str, Entry], year: int, quarter: int) -> str:
+    # Content digest of a quarter's source files
+    sig = signature(entries, year, quarter)
+    h = hashlib.sha1()
+    for f in sorted(sig):
+        h.update(f'{f}:{sig[f][2]};'.encode())
+    return h.hexdigest()
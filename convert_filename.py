@@ -1,90 +1,159 @@
+from typing import Dict, Tuple
+import codecs
+import hashlib
+import json
+import multiprocessing
 import os, sys
-import platform
 import shutil
-import subprocess
-
-quarter = {
-    '1분기보고서': '1Q',
-    '반기보고서':  '2Q',
-    '3분기보고서': '3Q',
-    '사업보고서':  '4Q'
-}
-
-types = {
-    '현금흐름표'   : 'CF',
-    '손익계산서'   : 'PL',
-    '포괄손익계산서': 'CPL',
-    '재무상태표'   : 'BS',
-    '자본변동표'   : 'CE'
-}
-
-failed_list = []
-try:
-    os.mkdir('converted')
-except FileExistsError:
-    pass
-
-files = os.listdir('.')
-files.sort()
-for f in files:
-    if f.endswith('.txt'):
-
-        q = None
-        t = None
-        year = int(f[:4])
-        for key in quarter:
-            if f.find(key) != -1:                
-                q = quarter[key]                
-                break
-        for key in types:
-            if f.find(key) != -1:
-                t = types[key]
-                if t == 'PL':
-                    if f.find('포괄손익계산서') != -1:
-                        t = 'CPL'
-                break
-        
-        if q == None or t == None:
-            continue
+import tempfile
+
+import archive
+
+# Converts DART downloads in the current directory to UTF-8 files named like 2021-1Q-CPL-c.txt and
+# KRX Stocks.csv files to UTF-8 in place. Originals are moved to ./converted.
+# Converted files are recorded in the manifest with their hashes, so a rerun skips them.
+
+_manifest_filename = 'convert-manifest.json'
+_chunk_size = 1 << 20
+
+
+def _is_utf8(path: str) -> bool:
+    # BOM or valid UTF-8 throughout
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(path, 'rb') as fin:
+        bom = fin.read(3)
+        if len(bom) == 3 and bom[0] == 0xEF and bom[1] == 0xBB and bom[2] == 0xBF:
+            return True
+        try:
+            decoder.decode(bom)
+            for chunk in iter(lambda: fin.read(_chunk_size), b''):
+                decoder.decode(chunk)
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            return False
+    return True
+
+
+def _transcode(src: str, dst: str) -> str:
+    # Streams src from EUC-KR (CP949) to UTF-8, written atomically, returns the hash of dst.
+    # The temporary file is unique to the call, with the permissions of src.
+    decoder = codecs.getincrementaldecoder(archive.encoding)()
+    h = hashlib.sha1()
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst) or '.', prefix=os.path.basename(dst) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fout, open(src, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(_chunk_size), b''):
+                data = decoder.decode(chunk).encode('utf-8')
+                h.update(data)
+                fout.write(data)
+            data = decoder.decode(b'', final=True).encode('utf-8')
+            h.update(data)
+            fout.write(data)
+        shutil.copymode(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return h.hexdigest()
+
+
+def _convert(task: Tuple[str, str]) -> Tuple[str, Dict, str]:
+    # Runs in a worker, returns (source, manifest entry, error)
+    src, dst = task
+    try:
+        if dst == src:
+            # Stocks.csv, converted in place unless already UTF-8
+            if _is_utf8(src):
+                return src, {'target': dst, 'hash': archive.file_hash(src)}, None
+            return src, {'target': dst, 'hash': _transcode(src, dst)}, None
+        source_hash = archive.file_hash(src)
+        target_hash = _transcode(src, dst)
+        shutil.move(src, os.path.join('converted', src))
+        return src, {'source': source_hash, 'target': dst, 'hash': target_hash}, None
+    except (OSError, UnicodeDecodeError) as e:
+        return src, None, f'{type(e).__name__}: {e}'
+
+
+def _load_manifest() -> Dict[str, Dict]:
+    if not os.path.exists(_manifest_filename):
+        return {}
+    with open(_manifest_filename, 'r', encoding='utf-8') as fin:
+        return json.load(fin)
+
+
+def _save_manifest(manifest: Dict[str, Dict]) -> None:
+    tmp = _manifest_filename + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as fout:
+        json.dump(manifest, fout, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp, _manifest_filename)
 
-        print(f'Converting {f} ', end='')        
-        c = '-c' if f.find('연결') != -1 else ''
-
-        nf = f'{year}-{q}-{t}{c}.txt'
-        print(f'to {nf}')
-        failed = False
-        sysinfo = platform.system().lower()
-        if sysinfo.find('windows') != -1:
-            subprocess.run(f'powershell "Get-Content {f} | Set-Content -Encoding utf8 {nf}"', shell=True)            
-        elif sysinfo.find('linux') != -1:
-            pass      
-        '''
-        with open(f, 'r', encoding='euc-kr') as fin:
-            with open(nf, 'w', encoding='utf8') as fout:
-                try:
-                    fout.write(fin.read())
-                except:
-                    failed = True
-                    failed_list.append(f)
-        '''
-        if not failed:
-            s = os.path.getsize(f)
-            ns = os.path.getsize(nf)
-            shutil.move(f, f'./converted/{f}')
+
+def _done(manifest: Dict[str, Dict], src: str, dst: str) -> bool:
+    # Converted before and neither file changed since
+    entry = manifest.get(src)
+    if entry is None or entry['target'] != dst or not os.path.exists(dst):
+        return False
+    if src != dst and entry.get('source') != archive.file_hash(src):
+        return False
+    return entry['hash'] == archive.file_hash(dst)
+
+
+def convert(workers: int = None) -> int:
+    os.makedirs('converted', exist_ok=True)
+    manifest = _load_manifest()
+
+    # target -> source. Several downloads of a statement have the same target, the latest (greatest date suffix)
+    # is converted as in archive.scan_zip and the others are moved to ./converted.
+    sources = {}
+    superseded = []
+    for f in sorted(os.listdir('.')):
+        if f.endswith('.txt'):
+            parsed = archive.parse_name(f)
+            if parsed is None:
+                continue
+            nf = archive.filename(*parsed)
+        elif f.endswith('Stocks.csv'):
+            nf = f
         else:
-            os.remove(nf)
-    elif f.endswith('Stocks.csv'):
-        with open(f, 'rb') as fin:
-            # Skip UTF-8 file
-            bom = fin.read(3)
-            if bom[0] == 0xEF and bom[1] == 0xBB and bom[3] == 0xBF:
+            continue
+        if nf in sources:
+            superseded.append(sources[nf])
+        sources[nf] = f
+
+    for f in superseded:
+        print(f'Skipped {f}, downloaded again')
+        shutil.move(f, os.path.join('converted', f))
+
+    tasks = []
+    for nf, f in sources.items():
+        if _done(manifest, f, nf):
+            # Downloaded again
+            if f != nf:
+                shutil.move(f, os.path.join('converted', f))
+            continue
+        tasks.append((f, nf))
+
+    if len(tasks) == 0:
+        return 0
+
+    failed_list = []
+    workers = min(workers or multiprocessing.cpu_count(), len(tasks))
+    with multiprocessing.Pool(workers) as pool:
+        for src, entry, error in pool.imap_unordered(_convert, tasks):
+            if error is not None:
+                failed_list.append(src)
+                print(f'Failed to convert {src}: {error}')
                 continue
+            print(f'Converted {src} to {entry["target"]}')
+            manifest[src] = entry
+    _save_manifest(manifest)
+
+    if len(failed_list) > 0:
+        print(f'{len(failed_list)} files failed')
+    return len(tasks) - len(failed_list)
+
 
-        print(f'Converting {f}')
-        sysinfo = platform.system().lower()
-        if sysinfo.find('windows') != -1:
-            subprocess.run(f'powershell "Get-Content {f} | Set-Content -Encoding utf8 {f}.utf8"', shell=True)            
-            shutil.move(f'{f}.utf8', f)
-        elif sysinfo.find('linux') != -1:
-            pass   
-    
\ No newline at end of file
+if __name__ == '__main__':
+    # convert_filename.py [workers]
+    convert(int(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -6,42 +6,166 @@ import pandas as pd
 import sqlite3
 import corp
 import krx
+import catalog
 import sys, os
 import numpy as np
 
-import multiprocessing
+import ingest
+import dataset
+import instrument
+import panel
+import schema
 
-_sqlite_filename = 'halq.db'
-_table_name = 'krx'
+_sqlite_filename = schema.sqlite_filename
+_table_name = schema.table_name
 
+# Previous quarter and same quarter of the previous year, by quarter index (year*4+quarter).
+# RANGE frames only contain a row whose index is exactly 1 or 4 less, so missing quarters give NULL
+# and 1Q rolls over to 4Q of the previous year.
+# QoQ values compare standalone quarters ({field}_q, see panel), so 4Q is not compared as a whole year.
+# YoY values come from the previous-year amounts of the same report ({field}_prior, as restated), the row of
+# the previous year only fills in quarters whose files have no such column, so a new quarter needs no history.
 _indicator_sql = [
-    f'UPDATE {_table_name} SET fscore_k=0',
-    f'UPDATE {_table_name} SET fscore_k=fscore_k+1 WHERE equity_issue > 0',
-    f'UPDATE {_table_name} SET fscore_k=fscore_k+1 WHERE net_income > 0',
-    f'UPDATE {_table_name} SET fscore_k=fscore_k+1 WHERE cash_flow > 0',
-
-    f'UPDATE {_table_name} SET qoq_profit=    (SELECT profit     FROM {_table_name} old WHERE old.stock={_table_name}.stock AND old.year={_table_name}.year   AND old.quarter={_table_name}.quarter-1) WHERE quarter > 1',            # QoQ Profit (2~4Q)
-    f'UPDATE {_table_name} SET qoq_profit=    (SELECT profit     FROM {_table_name} old WHERE old.stock={_table_name}.stock AND old.year={_table_name}.year-1 AND old.quarter=4)                       WHERE quarter = 1',            # QoQ Profit (1Q)
-    f'UPDATE {_table_name} SET qoq_net_income=(SELECT net_income FROM {_table_name} old WHERE old.stock={_table_name}.stock AND old.year={_table_name}.year   AND old.quarter={_table_name}.quarter-1) WHERE quarter > 1',            # QoQ Net Income (2~4Q)
-    f'UPDATE {_table_name} SET qoq_net_income=(SELECT net_income FROM {_table_name} old WHERE old.stock={_table_name}.stock AND old.year={_table_name}.year-1 AND old.quarter=4)                       WHERE quarter = 1',            # QoQ Net Income (1Q)
-    f'UPDATE {_table_name} SET qoq_assets=    (SELECT assets     FROM {_table_name} old WHERE old.stock={_table_name}.stock AND old.year={_table_name}.year   AND old.quarter={_table_name}.quarter-1) WHERE quarter > 1',            # QoQ Net Assets (2~4Q)
-    f'UPDATE {_table_name} SET qoq_assets=    (SELECT assets     FROM {_table_name} old WHERE old.stock={_table_name}.stock AND old.year={_table_name}.year-1 AND old.quarter=4)                       WHERE quarter = 1',            # QoQ Net Assets (1Q)
-    f'UPDATE {_table_name} SET qoq_book_value=(SELECT book_value FROM {_table_name} old WHERE old.stock={_table_name}.stock AND old.year={_table_name}.year   AND old.quarter={_table_name}.quarter-1) WHERE quarter > 1',            # QoQ Net Book Value (2~4Q)
-    f'UPDATE {_table_name} SET qoq_book_value=(SELECT book_value FROM {_table_name} old WHERE old.stock={_table_name}.stock AND old.year={_table_name}.year-1 AND old.quarter=4)                       WHERE quarter = 1',            # QoQ Net Book Value (1Q)    
-    
-    f'UPDATE {_table_name} SET yoy_profit=    (SELECT profit     FROM {_table_name} old WHERE old.stock={_table_name}.stock AND old.year={_table_name}.year-1 AND old.quarter={_table_name}.quarter)',                                # YoY Profit
-    f'UPDATE {_table_name} SET yoy_net_income=(SELECT net_income FROM {_table_name} old WHERE old.stock={_table_name}.stock AND old.year={_table_name}.year-1 AND old.quarter={_table_name}.quarter)',                                # YoY Net Income
-    
-    f'UPDATE {_table_name} SET profit_growth_qoq    =(profit-qoq_profit)/qoq_profit',               # QoQ Profit Growth
-    f'UPDATE {_table_name} SET net_income_growth_qoq=(net_income-qoq_net_income)/qoq_net_income',   # QoQ Net Income Growth
-    f'UPDATE {_table_name} SET assets_growth_qoq    =(assets-qoq_assets)/qoq_assets',               # QoQ Assets Growth
-    f'UPDATE {_table_name} SET book_value_growth_qoq=(book_value-qoq_book_value)/qoq_book_value',   # QoQ Book Value Growth
-
-    f'UPDATE {_table_name} SET profit_growth_yoy    =(profit-yoy_profit)/yoy_profit',               # YoY Profit Growth
-    f'UPDATE {_table_name} SET net_income_growth_yoy=(net_income-yoy_net_income)/yoy_net_income',   # YoY Net Income Growth    
+    f'UPDATE {_table_name} SET fscore_k=IFNULL(equity_issue > 0, 0) + IFNULL(net_income > 0, 0) + IFNULL(cash_flow > 0, 0) WHERE {{scope}}',
+
+    f'''UPDATE {_table_name} SET
+        qoq_profit            =lag.qoq_profit,                                           -- QoQ Profit
+        qoq_net_income        =lag.qoq_net_income,                                       -- QoQ Net Income
+        qoq_assets            =lag.qoq_assets,                                           -- QoQ Assets
+        qoq_book_value        =lag.qoq_book_value,                                       -- QoQ Book Value
+        yoy_profit            =lag.yoy_profit,                                           -- YoY Profit
+        yoy_net_income        =lag.yoy_net_income,                                       -- YoY Net Income
+        profit_growth_qoq     =(profit_q-lag.qoq_profit)*1.0/lag.qoq_profit,             -- QoQ Profit Growth
+        net_income_growth_qoq =(net_income_q-lag.qoq_net_income)*1.0/lag.qoq_net_income, -- QoQ Net Income Growth
+        assets_growth_qoq     =(assets-lag.qoq_assets)*1.0/lag.qoq_assets,               -- QoQ Assets Growth
+        book_value_growth_qoq =(book_value-lag.qoq_book_value)*1.0/lag.qoq_book_value,   -- QoQ Book Value Growth
+        profit_growth_yoy     =(profit-lag.yoy_profit)*1.0/lag.yoy_profit,               -- YoY Profit Growth
+        net_income_growth_yoy =(net_income-lag.yoy_net_income)*1.0/lag.yoy_net_income    -- YoY Net Income Growth
+    FROM (
+        SELECT stock, year, quarter,
+            FIRST_VALUE(profit_q)     OVER qoq AS qoq_profit,
+            FIRST_VALUE(net_income_q) OVER qoq AS qoq_net_income,
+            FIRST_VALUE(assets)       OVER qoq AS qoq_assets,
+            FIRST_VALUE(book_value)   OVER qoq AS qoq_book_value,
+            COALESCE(profit_prior,     FIRST_VALUE(profit)     OVER yoy) AS yoy_profit,
+            COALESCE(net_income_prior, FIRST_VALUE(net_income) OVER yoy) AS yoy_net_income
+        FROM {_table_name}
+        WINDOW
+            qoq AS (PARTITION BY stock ORDER BY year*4+quarter RANGE BETWEEN 1 PRECEDING AND 1 PRECEDING),
+            yoy AS (PARTITION BY stock ORDER BY year*4+quarter RANGE BETWEEN 4 PRECEDING AND 4 PRECEDING)
+    ) AS lag
+    WHERE {_table_name}.stock=lag.stock AND {_table_name}.year=lag.year AND {_table_name}.quarter=lag.quarter AND {{scope}}''',
+]
+
+
+# Columns calculated after the DataFrame is written
+# Stage names of _indicator_sql
+_indicator_names = ['fscore', 'qoq_yoy']
+
+_sql_money_columns = ['qoq_net_income', 'qoq_profit', 'qoq_book_value', 'qoq_assets', 'yoy_net_income', 'yoy_profit']
+_sql_real_columns = [
+    'profit_growth_qoq', 'profit_growth_yoy', 'net_income_growth_qoq', 'net_income_growth_yoy', 'book_value_growth_qoq', 'assets_growth_qoq',
+]
+_sql_int_columns = [
+    'ord_ipbr', 'ord_iper', 'ord_ipsr', 'ord_ipfcr', 'ord_ipcr', 'ord_profit_growth_qoq', 'ord_profit_growth_yoy',
+    'ord_net_income_growth_qoq', 'ord_net_income_growth_yoy', 'ord_book_value_growth_qoq', 'ord_assets_growth_qoq',
+    'fscore_k',
 ]
 
+# Column types of the krx table, every other column is a REAL ratio.
+# Money amounts are whole KRW and stored as INTEGER.
+_text_columns = {'name', 'stock', 'market'}
+_integer_columns = set(['year', 'quarter'] + corp.fields + ['capex', 'market_cap', 'book_value', 'fcf', 'sales_profit'] + _sql_money_columns + _sql_int_columns + panel.money_columns)
+
+# Relaxed durability while bulk loading a new database, a failed build is simply rebuilt
+_bulk_pragmas = [
+    'PRAGMA journal_mode=MEMORY',
+    'PRAGMA synchronous=OFF',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-262144',
+]
+
+_build_table = schema.build_table
+_affected_table = 'affected'
+_panel_table = 'panel'
+# Quarters derived at a time by _derive_panel, besides the panel.history quarters read before them
+_panel_chunk = 4
+_quality_table = 'quality'
+_completeness_table = 'completeness'
+_aggregate_table = schema.aggregate_table
+_all_scope = '1'
+_affected_scope = f'({_table_name}.year, {_table_name}.quarter) IN (SELECT year, quarter FROM {_affected_table})'
+
+
+# Ranked columns, descending
+_rank_columns = [
+    ('iper', True),
+    ('ipbr', True),
+    ('ipcr', True),
+    ('ipfcr', True),
+    ('ipsr', True),
+    ('profit_growth_qoq', True),
+    ('net_income_growth_qoq', True),
+    ('assets_growth_qoq', False),
+    ('book_value_growth_qoq', False),
+    ('profit_growth_yoy', True),
+    ('net_income_growth_yoy', True),
+]
+
+# Cross-sectional statistics of each (year, quarter, market), one row per column. Infinite ratios are left out.
+_aggregate_columns = ['per', 'pbr', 'psr', 'pcr', 'roe', 'roa', 'gpa']
+_aggregate_stats = ['count', 'mean', 'std', 'min', 'p10', 'p25', 'median', 'p75', 'p90', 'max']
+_aggregate_quantiles = [0.1, 0.25, 0.5, 0.75, 0.9]
+
+# Covering index of the screens of screen.py: their filters, rank columns and results in quarter order
+_rank_index = schema.rank_index
+_rank_index_columns = ['year', 'quarter', 'market', 'fscore_k'] + [f'ord_{col}' for col, _ in _rank_columns] + ['stock', 'name']
+
+_rank_methods = {
+    'row_number': 'ROW_NUMBER()',       # 1..n, ties broken by stock code
+    'rank':       'RANK()',             # ties share a rank, with gaps
+    'dense_rank': 'DENSE_RANK()',       # ties share a rank, without gaps
+    'percent':    'PERCENT_RANK()',     # 0.0 (best) .. 1.0
+}
+
+
+def rank_corps(cursor: sqlite3.Cursor, scope: str = _all_scope, by_market: bool = False, method: str = 'row_number', nulls: str = 'last', prefix: str = 'ord_') -> int:
+    # Ranks every (year, quarter) partition in scope with one window pass.
+    # by_market: rank KOSPI and KOSDAQ separately
+    # nulls: 'last' ranks NULL values after every value, 'null' leaves their rank NULL
+    # prefix: destination columns, created if missing (e.g. 'pct_' with method='percent')
+    if method not in _rank_methods:
+        raise ValueError(f'Unknown rank method: {method}')
+    if nulls not in ('last', 'null'):
+        raise ValueError(f'Unknown NULL handling: {nulls}')
+
+    existing = {r[1] for r in cursor.execute(f'PRAGMA table_info({_table_name})')}
+    for col, _ in _rank_columns:
+        if prefix + col not in existing:
+            cursor.execute(f'ALTER TABLE {_table_name} ADD COLUMN {prefix}{col} {"REAL" if method == "percent" else "INTEGER"}')
+
+    selects = []
+    for col, desc in _rank_columns:
+        # Values are compared as numbers even where the column has TEXT affinity
+        key = f'CAST({col} AS REAL)'
+        partition = 'year, quarter' + (', market' if by_market else '') + (f', {col} IS NULL' if nulls == 'null' else '')
+        window = f'PARTITION BY {partition} ORDER BY {col} IS NULL, {key} {"DESC" if desc else "ASC"}, stock'
+        expr = f'{_rank_methods[method]} OVER ({window})'
+        if nulls == 'null':
+            expr = f'CASE WHEN {col} IS NULL THEN NULL ELSE {expr} END'
+        selects.append(f'{expr} AS {col}')
+
+    sets = ', '.join(f'{prefix}{col}=sorted.{col}' for col, _ in _rank_columns)
+    sql = f'''UPDATE {_table_name} SET {sets}
+        FROM (SELECT stock, year, quarter, {', '.join(selects)} FROM {_table_name} WHERE {scope}) AS sorted
+        WHERE {_table_name}.stock=sorted.stock AND {_table_name}.year=sorted.year AND {_table_name}.quarter=sorted.quarter'''
+    with instrument.stage(f'rank.{prefix}{method}') as s:
+        count = calculate_indicators(sql, cursor)
+        s.rows = count
+    return count
 
+
+@instrument.profiled
 def cal():
     if not os.path.exists(_sqlite_filename):
         print(f'{_sqlite_filename} does not exist.')
@@ -49,58 +173,79 @@ def cal():
 
     conn = sqlite3.connect(_sqlite_filename)
     cur = conn.cursor()
-    for sql in _indicator_sql:
-        calculate_indicators(sql, cur)
+
+    # Columns added since the database was built
+    existing = {r[1] for r in cur.execute(f'PRAGMA table_info({_table_name})')}
+    for col in corp.fields + panel.columns:
+        if col not in existing:
+            cur.execute(f'ALTER TABLE {_table_name} ADD COLUMN {col} {_column_type(col)}')
+
+    quarters = [(r[0], r[1]) for r in cur.execute(f'SELECT DISTINCT year, quarter FROM {_table_name} ORDER BY year, quarter')]
+    if len(quarters) > 0:
+        with instrument.stage('panel') as s:
+            s.rows = _derive_panel(cur, quarters)
+    # Aggregates of databases built before they were kept
+    with instrument.stage('aggregates') as s:
+        s.rows = 0
+        for t in quarters:
+            df = pd.read_sql_query(f'SELECT market, {", ".join(_aggregate_columns)} FROM {_table_name} WHERE year=? AND quarter=?', conn, params=t)
+            s.rows += _replace_aggregates(cur, *t, df)
+    for name, sql in zip(_indicator_names, _indicator_sql):
+        with instrument.stage(f'sql.{name}') as s:
+            s.rows = calculate_indicators(sql.format(scope=_all_scope), cur)
 
     cur.close()
     conn.commit()
     conn.close()
 
 
-def prep(begin_year: int, begin_quarter: int, end_year: int, end_quarter: int) -> None:
-    corps = None
-    year = begin_year
-    quarter = begin_quarter
+def _next_quarter(year: int, quarter: int) -> Tuple[int, int]:
+    return (year + 1, 1) if quarter == 4 else (year, quarter + 1)
 
-    # Delete SQLite database file if exists
-    if os.path.exists(_sqlite_filename):
-        print(f'Removing file {_sqlite_filename}')
-        os.remove(_sqlite_filename)
 
-    tlist: List[List[Tuple[int, int]]] = []     # year, quarter
-    clist: List[List[corp.Corp]]       = []     # coporations
+def _affected_quarters(changed: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    # QoQ values and standalone flows of the following quarter, TTM flows of the following three quarters
+    # and YoY values of the same quarter next year depend on a changed quarter
+    affected = set(changed)
+    for year, quarter in changed:
+        t = (year, quarter)
+        for _ in range(3):
+            t = _next_quarter(*t)
+            affected.add(t)
+        affected.add((year + 1, quarter))
+    return sorted(affected)
 
-    while year * 10 + quarter <= end_year * 10 + end_quarter:    
-        # Load corporations
-        if krx.data_exists(year, quarter):        
-            tlist.append((year, quarter))
 
-        # Next quarter
-        quarter += 1
-        if quarter == 5:
-            quarter = 1
-            year += 1
-    
-    if len(tlist) == 0:
-        return
+def _changed_quarters(conn: sqlite3.Connection, tlist: List[Tuple[int, int]], entries: Dict[str, catalog.Entry]) -> Dict[Tuple[int, int], str]:
+    # Read only, conn may be the live halq.db
+    cur = conn.cursor()
+    built = {}
+    if cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (_build_table,)).fetchone() is not None:
+        built = {(r[0], r[1]): r[2] for r in cur.execute(f'SELECT year, quarter, signature FROM {_build_table}')}
+    cur.close()
+
+    changed = {}
+    for t in tlist:
+        sig = krx.quarter_signature(*t, entries)
+        if built.get(t) != sig:
+            changed[t] = sig
+    return changed
+
 
-    # Build DataFrame
-    print(f'Loading corporations from {tlist[0][0]}-{tlist[0][1]}Q to {tlist[-1][0]}-{tlist[-1][1]} ')
-    num_cores = multiprocessing.cpu_count() * 2
-    with multiprocessing.Pool(num_cores) as pool:
-        clist = pool.starmap(krx.load_dart_data, tlist)
-
-    dflist = []
-    for i, t in enumerate(tlist):
-        corps = clist[i]
-        d = pd.DataFrame([c.__dict__ for c in corps], index=[c.stock for c in corps])
-        d['year'] = t[0]
-        d['quarter'] = t[1]
-        dflist.append(d)
-    
-    # Caculcate simple indicators
-    print('Calculating simple indicators')
-    df = pd.concat(dflist)
+def _export_parquet(conn: sqlite3.Connection, affected: List[Tuple[int, int]]) -> None:
+    # Quarters rebuilt now and the ones never exported
+    built = [(r[0], r[1]) for r in conn.execute(f'SELECT year, quarter FROM {_build_table}')]
+    quarters = sorted(set(affected) | (set(built) - set(dataset.quarters())))
+    print(f'Exporting {len(quarters)} quarters to {dataset._parquet_dir}')
+    dataset.write_quarters(conn, quarters)
+
+
+def _export_panel(conn: sqlite3.Connection) -> None:
+    p = panel.build(conn)
+    print(f'Wrote panel of {len(p.fields)} fields, {len(p.stocks)} stocks and {len(p.quarters)} quarters to {panel._panel_dir}')
+
+
+def _simple_indicators(df: pd.DataFrame) -> pd.DataFrame:
     df['capex'] = df['capex_intangible'] + df['capex_property']        # capex
     df['market_cap'] = df['price'] * df['shares']                      # Market Cap
     df['book_value'] = df['assets'] - df['liabilities']                # Book Value
@@ -120,64 +265,275 @@ def prep(begin_year: int, begin_quarter: int, end_year: int, end_quarter: int) -
     df['sales_profit'] = df['sales'] - df['sales_cost']                # Sales Profit (매출총이익)
     df['gpa'] = df['sales_profit'] / df['book_value']                  # GP/A
 
-  
+    # Columns filled in by the panel stage and SQL
+    for col in panel.columns + _sql_money_columns + _sql_real_columns + _sql_int_columns:
+        df[col] = np.nan
+    return df
 
-    # Create and open SQLite database file
-    conn = sqlite3.connect(_sqlite_filename)
+
+def _derive_panel(cursor: sqlite3.Cursor, quarters: List[Tuple[int, int]]) -> int:
+    # Sets the panel columns of the given quarters a few quarters at a time, so that only the inputs of
+    # _panel_chunk + panel.history quarters are held in memory
+    chunks = []
+    for t in quarters:
+        k = t[0] * 4 + t[1] - 1
+        if len(chunks) > 0 and k - chunks[-1][0] < _panel_chunk:
+            chunks[-1][1].append(t)
+        else:
+            chunks.append((k, [t]))
+    return sum(_derive_panel_chunk(cursor, c) for _, c in chunks)
+
+
+def _derive_panel_chunk(cursor: sqlite3.Cursor, quarters: List[Tuple[int, int]]) -> int:
+    # Derived with panel.history quarters before them in one pass over all stocks, and written with a single UPDATE
+    k = quarters[0][0] * 4 + quarters[0][1] - 1 - panel.history
+    begin, end = (k // 4, k % 4 + 1), quarters[-1]
+    df = pd.read_sql_query(f'SELECT {", ".join(panel.inputs)} FROM {_table_name} WHERE (year, quarter) BETWEEN (?, ?) AND (?, ?)',
+                           cursor.connection, params=(*begin, *end))
+    rows = pd.MultiIndex.from_arrays([df['year'], df['quarter']]).isin(quarters)
+    derived = panel.derive(df)[rows]
+    keys = df.loc[rows, ['stock', 'year', 'quarter']]
+    del df
+
+    defs = ', '.join(f'{col} {_column_type(col)}' for col in panel.columns)
+    cursor.execute(f'CREATE TEMP TABLE IF NOT EXISTS {_panel_table} (stock TEXT, year INTEGER, quarter INTEGER, {defs}, PRIMARY KEY (stock, year, quarter))')
+    cursor.execute(f'DELETE FROM {_panel_table}')
+    values = [keys[c].to_numpy(dtype=object) for c in keys.columns] + [_column_values(derived[col], _column_type(col)) for col in panel.columns]
+    cursor.executemany(f'INSERT INTO {_panel_table} VALUES ({", ".join("?" * (3 + len(panel.columns)))})', zip(*values))
+    sets = ', '.join(f'{col}=p.{col}' for col in panel.columns)
+    cursor.execute(f"""UPDATE {_table_name} SET {sets} FROM {_panel_table} AS p
+        WHERE {_table_name}.stock=p.stock AND {_table_name}.year=p.year AND {_table_name}.quarter=p.quarter""")
+    return len(keys)
+
+
+def _column_type(col: str) -> str:
+    if col in _text_columns:
+        return 'TEXT'
+    return 'INTEGER' if col in _integer_columns else 'REAL'
+
+
+def _create_table(cursor: sqlite3.Cursor, columns: List[str], without_rowid: bool = False) -> None:
+    defs = ', '.join(f'{col} {_column_type(col)}' + (' NOT NULL' if col in ('stock', 'year', 'quarter') else '') for col in columns)
+    cursor.execute(f'CREATE TABLE {_table_name} ({defs}, PRIMARY KEY (stock, year, quarter)){" WITHOUT ROWID" if without_rowid else ""}')
+
+
+def _column_values(s: pd.Series, type: str) -> np.ndarray:
+    # Python values for executemany, None for NaN
+    if type == 'TEXT':
+        return s.to_numpy(dtype=object)
+    v = s.to_numpy(dtype=np.float64)
+    missing = np.isnan(v)
+    out = (np.where(missing, 0, v).astype(np.int64) if type == 'INTEGER' else v).astype(object)
+    out[missing] = None
+    return out
+
+
+def _insert(cursor: sqlite3.Cursor, df: pd.DataFrame) -> None:
+    columns = list(df.columns)
+    values = [_column_values(df[col], _column_type(col)) for col in columns]
+    cursor.executemany(f'INSERT INTO {_table_name} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', zip(*values))
+
+
+def _replace_quality(cursor: sqlite3.Cursor, year: int, quarter: int, quality: pd.DataFrame, completeness: pd.DataFrame) -> None:
+    # Data-quality report of a quarter: rows skipped or invalid per file, and missing values per field
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS {_quality_table} (year INTEGER, quarter INTEGER, file TEXT, stock TEXT, account TEXT, value TEXT, reason TEXT)')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS index_{_quality_table} ON {_quality_table}(year, quarter)')
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS {_completeness_table} (year INTEGER, quarter INTEGER, field TEXT, missing INTEGER, total INTEGER, PRIMARY KEY (year, quarter, field))')
+    cursor.execute(f'DELETE FROM {_quality_table} WHERE year=? AND quarter=?', (year, quarter))
+    cursor.execute(f'DELETE FROM {_completeness_table} WHERE year=? AND quarter=?', (year, quarter))
+    cursor.executemany(f'INSERT INTO {_quality_table} VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       [(year, quarter, *(None if pd.isna(v) else str(v) for v in r)) for r in quality[corp.issue_columns].itertuples(index=False)])
+    cursor.executemany(f'INSERT INTO {_completeness_table} VALUES (?, ?, ?, ?, ?)',
+                       [(year, quarter, r.field, int(r.missing), int(r.total)) for r in completeness.itertuples(index=False)])
+
+
+def _replace_aggregates(cursor: sqlite3.Cursor, year: int, quarter: int, df: pd.DataFrame) -> int:
+    # Statistics of _aggregate_columns per market, from the rows of one quarter
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {_aggregate_table} (year INTEGER, quarter INTEGER, market TEXT, field TEXT,
+        {", ".join(f"{s} {'INTEGER' if s == 'count' else 'REAL'}" for s in _aggregate_stats)}, PRIMARY KEY (year, quarter, market, field))''')
+    cursor.execute(f'DELETE FROM {_aggregate_table} WHERE year=? AND quarter=?', (year, quarter))
+    values = df[_aggregate_columns].replace([np.inf, -np.inf], np.nan)
+    rows = []
+    for market, group in values.groupby(df['market']):
+        count, mean, std, low, high = group.count(), group.mean(), group.std(), group.min(), group.max()
+        q = group.quantile(_aggregate_quantiles)
+        for col in _aggregate_columns:
+            stats = [mean[col], std[col], low[col], *q[col], high[col]]
+            rows.append((year, quarter, market, col, int(count[col]), *(None if pd.isna(v) else float(v) for v in stats)))
+    cursor.executemany(f'INSERT INTO {_aggregate_table} VALUES ({", ".join("?" * (4 + len(_aggregate_stats)))})', rows)
+    return len(rows)
+
+
+@instrument.profiled
+def prep(begin_year: int, begin_quarter: int, end_year: int, end_quarter: int, full: bool = False, workers: int = None,
+         bulk: bool = None, without_rowid: bool = False, parquet: bool = False, build_panel: bool = False) -> None:
+    # bulk: load in one transaction with relaxed PRAGMAs, by default when the table is created
+    # without_rowid: create the table WITHOUT ROWID
+    # parquet: also export the krx table to dataset._parquet_dir
+    # build_panel: also write the dense panel of the krx table to panel._panel_dir
+    # full: rebuild every quarter into a new database
+    if full and parquet:
+        dataset.remove()
+    if full and build_panel:
+        panel.remove()
+
+    # Complete quarters in range, from one scan of dart-data
+    with instrument.stage('catalog.scan'):
+        entries = catalog.scan()
+    tlist = [t for t in catalog.quarters(entries) if (begin_year, begin_quarter) <= t <= (end_year, end_quarter)]
+
+    if len(tlist) == 0:
+        return
+
+    # The build goes into a copy of halq.db renamed over it when done, so readers never see a partial build
+    building = _sqlite_filename + '.build'
+    if os.path.exists(building):
+        os.remove(building)
+    current = not full and os.path.exists(_sqlite_filename)
+    conn = sqlite3.connect(f'file:{_sqlite_filename}?mode=ro', uri=True) if current else sqlite3.connect(building)
     conn.row_factory = sqlite3.Row
-    df.to_sql(_table_name, conn, if_exists='append')
+
+    # Only new or changed quarters are loaded
+    with instrument.stage('changed_quarters'):
+        changed = _changed_quarters(conn, tlist, entries)
+    if len(changed) == 0:
+        print(f'{_sqlite_filename} is up to date')
+        if parquet:
+            _export_parquet(conn, [])
+        if build_panel and not panel.up_to_date(conn):
+            _export_panel(conn)
+        conn.close()
+        return
+    if current:
+        # A consistent snapshot even while halq.db is written by others
+        with instrument.stage('copy'):
+            copy = sqlite3.connect(building)
+            conn.backup(copy)
+            conn.close()
+            conn = copy
+            conn.row_factory = sqlite3.Row
+
+    try:
+        built = _build(conn, changed, workers, bulk, without_rowid, parquet, build_panel)
+    except BaseException:
+        conn.close()
+        os.remove(building)
+        raise
+    conn.close()
+    if built:
+        os.replace(building, _sqlite_filename)
+    else:
+        os.remove(building)
+
+
+def _build(conn: sqlite3.Connection, changed: Dict[Tuple[int, int], str], workers: int, bulk: bool, without_rowid: bool,
+           parquet: bool, build_panel: bool) -> bool:
+    # Loads the changed quarters into conn and updates the indicators depending on them, False if none was loaded
+    create = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (_table_name,)).fetchone() is None
+    tlist = sorted(changed)
+    if bulk is None:
+        bulk = create
+    if bulk:
+        for pragma in _bulk_pragmas:
+            conn.execute(pragma)
+
+    # Each quarter is appended as soon as it is loaded, so only a few quarters are held in memory at once
+    print(f'Loading corporations from {tlist[0][0]}-{tlist[0][1]}Q to {tlist[-1][0]}-{tlist[-1][1]}Q ({len(tlist)} quarters)')
     cur = conn.cursor()
+    existing = None if create else {r[1] for r in cur.execute(f'PRAGMA table_info({_table_name})')}
+    cur.execute(f'CREATE TABLE IF NOT EXISTS {_build_table} (year INTEGER, quarter INTEGER, signature TEXT, built_at TEXT, PRIMARY KEY (year, quarter))')
+    if bulk:
+        cur.execute('BEGIN')
+    loaded, partial = [], set()
+    for corps in ingest.load_quarters(tlist, workers):
+        t = (corps.year, corps.quarter)
+        if len(corps.failed) > 0:
+            partial.add(t)
+        with instrument.stage('dataframe', len(corps)):
+            df = corps.to_frame()
+        with instrument.stage('quality'):
+            _replace_quality(cur, *t, corps.quality(), corps.completeness())
+        del corps
+        with instrument.stage('simple_indicators', len(df)):
+            df = _simple_indicators(df)
+        with instrument.stage('aggregates') as s:
+            s.rows = _replace_aggregates(cur, *t, df)
 
-    cur.execute(f'CREATE INDEX index_year_quarter_stock on {_table_name}(year, quarter, stock)')
-    cur.execute(f'CREATE INDEX index_year_quarter on {_table_name}(year, quarter)')
-    cur.execute(f'CREATE UNIQUE INDEX index_key on {_table_name}(year, quarter, stock)')
+        # Replace the quarter
+        if existing is not None:
+            cur.execute(f'DELETE FROM {_table_name} WHERE year=? AND quarter=?', t)
 
-    conn.commit()
+            # Fields added to accounts.taxonomy since the table was created
+            for col in df.columns:
+                if col not in existing:
+                    cur.execute(f'ALTER TABLE {_table_name} ADD COLUMN {col} {_column_type(col)}')
+                    existing.add(col)
+        else:
+            _create_table(cur, list(df.columns), without_rowid)
+            existing = set(df.columns)
+        with instrument.stage('insert', len(df)):
+            _insert(cur, df)
+            if not bulk:
+                conn.commit()
+        del df
+        loaded.append(t)
+
+    # Quarters failed to load are left as they are and retried next time
+    tlist = sorted(loaded)
+    if len(tlist) == 0:
+        cur.close()
+        return False
+
+    # The primary key serves lookups by stock, index_key those by quarter.
+    # index_year_quarter_stock and index_year_quarter of older databases duplicate index_key.
+    with instrument.stage('index'):
+        cur.execute('DROP INDEX IF EXISTS index_year_quarter_stock')
+        cur.execute('DROP INDEX IF EXISTS index_year_quarter')
+        cur.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS index_key on {_table_name}(year, quarter, stock)')
+        if not bulk:
+            conn.commit()
+
+    # Rows whose QoQ, YoY values depend on the changed quarters
+    affected = _affected_quarters(tlist) if not create else tlist
+    cur.execute(f'CREATE TEMP TABLE IF NOT EXISTS {_affected_table} (year INTEGER, quarter INTEGER)')
+    cur.execute(f'DELETE FROM {_affected_table}')
+    cur.executemany(f'INSERT INTO {_affected_table} VALUES (?, ?)', affected)
+
+    print('Deriving standalone quarter and TTM flows')
+    with instrument.stage('panel') as s:
+        s.rows = _derive_panel(cur, affected)
 
     print('Calculating QoQ, YoY indicators')
-    for sql in _indicator_sql:
-        calculate_indicators(sql, cur)
-    conn.commit()
+    for name, sql in zip(_indicator_names, _indicator_sql):
+        with instrument.stage(f'sql.{name}') as s:
+            s.rows = calculate_indicators(sql.format(scope=_affected_scope), cur)
+    if not bulk:
+        conn.commit()
 
 
     print('Ranking corporations by some indicators')
-    for t in tlist:
-        year = t[0]
-        quarter = t[1]
-        sql = f'WITH  sorted AS (\
-                SELECT \
-                    year, quarter, stock, \
-                    ROW_NUMBER() OVER (ORDER BY iper DESC) as iper_sorted, \
-                    ROW_NUMBER() OVER (ORDER BY ipbr DESC) as ipbr_sorted, \
-                    ROW_NUMBER() OVER (ORDER BY ipcr DESC) as ipcr_sorted, \
-                    ROW_NUMBER() OVER (ORDER BY ipfcr DESC) as ipfcr_sorted, \
-                    ROW_NUMBER() OVER (ORDER BY ipsr DESC) AS ipsr_sorted, \
-                    ROW_NUMBER() OVER (ORDER BY profit_growth_qoq DESC) AS profit_growth_qoq_sorted, \
-                    ROW_NUMBER() OVER (ORDER BY net_income_growth_qoq DESC) AS net_income_growth_qoq_sorted, \
-                    ROW_NUMBER() OVER (ORDER BY assets_growth_qoq) AS assets_growth_qoq_sorted, \
-                    ROW_NUMBER() OVER (ORDER BY book_value_growth_qoq) AS book_value_growth_qoq_sorted, \
-                    ROW_NUMBER() OVER (ORDER BY profit_growth_yoy DESC) AS profit_growth_yoy_sorted, \
-                    ROW_NUMBER() OVER (ORDER BY net_income_growth_yoy DESC) AS net_income_growth_yoy_sorted \
-                FROM krx \
-                WHERE year={year} AND quarter={quarter} \
-                ) \
-                UPDATE  krx SET \
-                    ord_iper=(SELECT iper_sorted FROM sorted WHERE krx.stock=sorted.stock), \
-                    ord_ipbr=(SELECT ipbr_sorted FROM sorted WHERE krx.stock=sorted.stock), \
-                    ord_ipcr=(SELECT ipcr_sorted FROM sorted WHERE krx.stock=sorted.stock), \
-                    ord_ipfcr=(SELECT ipfcr_sorted FROM sorted WHERE krx.stock=sorted.stock), \
-                    ord_ipsr=(SELECT ipsr_sorted FROM sorted WHERE krx.stock=sorted.stock), \
-                    ord_profit_growth_qoq     =(SELECT profit_growth_qoq_sorted     FROM sorted WHERE krx.stock=sorted.stock), \
-                    ord_net_income_growth_qoq =(SELECT net_income_growth_qoq_sorted FROM sorted WHERE krx.stock=sorted.stock), \
-                    ord_assets_growth_qoq     =(SELECT assets_growth_qoq_sorted     FROM sorted WHERE krx.stock=sorted.stock), \
-                    ord_book_value_growth_qoq =(SELECT book_value_growth_qoq_sorted FROM sorted WHERE krx.stock=sorted.stock), \
-                    ord_profit_growth_yoy     =(SELECT profit_growth_yoy_sorted     FROM sorted WHERE krx.stock=sorted.stock), \
-                    ord_net_income_growth_yoy =(SELECT net_income_growth_yoy_sorted FROM sorted WHERE krx.stock=sorted.stock) \
-                WHERE year={year} AND quarter={quarter} AND stock=(SELECT stock FROM sorted WHERE krx.stock=sorted.stock)'
-        cur.execute(sql)        
-    conn.commit()
+    rank_corps(cur, _affected_scope)
+    with instrument.stage('index.rank'):
+        cur.execute(f'CREATE INDEX IF NOT EXISTS {_rank_index} ON {_table_name}({", ".join(_rank_index_columns)})')
+
+    # Quarters with unreadable files lose their signature, so they are loaded again next time
+    built_at = datetime.now().isoformat(timespec='seconds')
+    cur.executemany(f'INSERT OR REPLACE INTO {_build_table} VALUES (?, ?, ?, ?)',
+                    [(t[0], t[1], changed[t], built_at) for t in tlist if t not in partial])
+    cur.executemany(f'DELETE FROM {_build_table} WHERE year=? AND quarter=?', sorted(partial))
+    with instrument.stage('commit'):
+        conn.commit()
+    if bulk:
+        with instrument.stage('analyze'):
+            cur.execute('ANALYZE')
+    if parquet:
+        with instrument.stage('parquet', len(affected)):
+            _export_parquet(conn, affected)
+    if build_panel:
+        with instrument.stage('dense_panel'):
+            _export_panel(conn)
     cur.close()
-    conn.close()
+    return True
 
 
 def calculate_indicators(sql: str, cursor: sqlite3.Cursor) -> int:
@@ -188,6 +544,38 @@ def calculate_indicators(sql: str, cursor: sqlite3.Cursor) -> int:
 
 
 if __name__ == '__main__':
+    # --full removes halq.db and rebuilds every quarter
+    full = '--full' in sys.argv
+    if full:
+        sys.argv.remove('--full')
+
+    # --bulk forces the bulk-load mode on an existing database, --without-rowid applies to a new one
+    bulk = True if '--bulk' in sys.argv else None
+    without_rowid = '--without-rowid' in sys.argv
+    # --parquet also exports the krx table as Parquet partitioned by year and quarter
+    parquet = '--parquet' in sys.argv
+    # --panel also writes the dense (field, stock, quarter) panel, see panel.Panel
+    build_panel = '--panel' in sys.argv
+    sys.argv = [a for a in sys.argv if a not in ('--bulk', '--without-rowid', '--parquet', '--panel')]
+
+    # --profile [file] emits stage timings as JSON (to stderr by default), --cprofile file dumps cProfile stats
+    if '--profile' in sys.argv:
+        i = sys.argv.index('--profile')
+        output = sys.argv[i + 1] if i + 1 < len(sys.argv) and not sys.argv[i + 1].isdigit() and not sys.argv[i + 1].startswith('--') else None
+        del sys.argv[i:i + (2 if output else 1)]
+        instrument.enable(output)
+    if '--cprofile' in sys.argv:
+        i = sys.argv.index('--cprofile')
+        os.environ[instrument._cprofile_env] = sys.argv[i + 1]
+        del sys.argv[i:i + 2]
+
+    # --workers N bounds the number of parsing processes
+    workers = None
+    if '--workers' in sys.argv:
+        i = sys.argv.index('--workers')
+        workers = int(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+
     if len(sys.argv) == 1:
         year_start = 2016
         quarter_start = 1
@@ -203,7 +591,7 @@ if __name__ == '__main__':
         year_end = int(sys.argv[3])
         quarter_end = int(sys.argv[4])
     else:
-        print('convert_sqlite.py [start year] [start quarter] [end year] [end quarter]')
+        print('convert_sqlite.py [--full] [--bulk] [--without-rowid] [--parquet] [--panel] [--profile [file]] [--cprofile file] [--workers N] [start year] [start quarter] [end year] [end quarter]')
         sys.exit(1)
 
-    prep(year_start, quarter_start, year_end, quarter_end)
+    prep(year_start, quarter_start, year_end, quarter_end, full, workers, bulk, without_rowid, parquet, build_panel)
@@ -1,5 +1,11 @@
 from __future__ import annotations
 from enum import Enum
+from typing import Dict, Iterator, List
+
+import numpy as np
+import pandas as pd
+
+import accounts
 
 
 class Market(str, Enum):
@@ -7,76 +13,147 @@ class Market(str, Enum):
     KOSDAQ = 'KOSDAQ'
 
 
-class Corp:
-    def __init__(self, name:str, stock:str, market:Market, year:int, quarter:int):
-        self.name = name
-        self.stock = stock
-        self.market = market
+# Values read from DART files (see accounts.taxonomy and accounts.periods) and Stocks.csv, stored as float64 (NaN for missing)
+fields = accounts.fields + accounts.period_fields + ['price', 'shares']
+field_index = {f: i for i, f in enumerate(fields)}
+
+# Data-quality rows of the source files: invalid amounts, malformed rows and unreadable files
+issue_columns = ['file', 'stock', 'account', 'value', 'reason']
+
+
+class CorpBatch:
+    # Corporations of one quarter, one row per stock and one NumPy row per field
+    def __init__(self, year: int, quarter: int, capacity: int = 1024):
         self.year = year
         self.quarter = quarter
+        self.index: Dict[str, int] = {}     # stock -> row
+        self.stock: List[str] = []
+        self.name: List[str] = []
+        self.market: List[Market] = []
+        self.values = self._empty(capacity)
+        self.issues: List[pd.DataFrame] = []
+        self.failed: List[str] = []         # files that could not be parsed
+
+    @staticmethod
+    def _empty(capacity: int) -> np.ndarray:
+        values = np.full((len(fields), capacity), np.nan)
+        for f, v in accounts.defaults.items():
+            values[field_index[f]] = v
+        return values
+
+    def __len__(self) -> int:
+        return len(self.stock)
+
+    def __contains__(self, stock: str) -> bool:
+        return stock in self.index
+
+    def __getitem__(self, stock: str) -> Corp:
+        return Corp(self, self.index[stock])
+
+    def __iter__(self) -> Iterator[Corp]:
+        return (Corp(self, row) for row in range(len(self)))
+
+    def __getstate__(self):
+        # Only the used rows are pickled back from pool workers
+        state = self.__dict__.copy()
+        state['values'] = self.values[:, :len(self)]
+        return state
+
+    def add(self, name: str, stock: str, market: Market) -> int:
+        row = len(self.stock)
+        if row == self.values.shape[1]:
+            grown = self._empty(max(row * 2, 16))
+            grown[:, :row] = self.values
+            self.values = grown
+        self.index[stock] = row
+        self.stock.append(stock)
+        self.name.append(name)
+        self.market.append(market)
+        return row
+
+    def set(self, row: int, field: str, value) -> None:
+        self.values[field_index[field], row] = np.nan if value is None else value
+
+    def get(self, row: int, field: str):
+        v = self.values[field_index[field], row]
+        return None if np.isnan(v) else int(v)
+
+    def add_issues(self, issues: pd.DataFrame) -> None:
+        if len(issues) > 0:
+            self.issues.append(issues)
+
+    def quality(self) -> pd.DataFrame:
+        if len(self.issues) == 0:
+            return pd.DataFrame({c: pd.Series(dtype=object) for c in issue_columns})
+        return pd.concat(self.issues, ignore_index=True)[issue_columns]
+
+    def completeness(self) -> pd.DataFrame:
+        # Corporations missing each field
+        missing = np.isnan(self.values[:, :len(self)]).sum(axis=1)
+        return pd.DataFrame({'field': fields, 'missing': missing, 'total': len(self)})
+
+    def column(self, field: str) -> np.ndarray:
+        return self.values[field_index[field], :len(self)]
+
+    def to_frame(self) -> pd.DataFrame:
+        # Numeric columns are views of self.values
+        n = len(self)
+        df = pd.DataFrame(self.values[:, :n].T, columns=fields, index=self.stock, copy=False)
+        df.insert(0, 'name', self.name)
+        df.insert(1, 'stock', self.stock)
+        df.insert(2, 'market', [m.value for m in self.market])
+        df.insert(3, 'year', self.year)
+        df.insert(4, 'quarter', self.quarter)
+        return df
+
+    @classmethod
+    def from_arrays(cls, year: int, quarter: int, stock: List[str], name: List[str], market: List[str], values: np.ndarray,
+                    issues: pd.DataFrame = None) -> CorpBatch:
+        batch = cls(year, quarter, 0)
+        batch.stock = list(stock)
+        batch.name = list(name)
+        batch.market = [Market(m) for m in market]
+        batch.index = {s: i for i, s in enumerate(batch.stock)}
+        batch.values = values
+        if issues is not None:
+            batch.add_issues(issues)
+        return batch
+
+
+class Corp:
+    # Attribute access to one row of a CorpBatch
+    __slots__ = ('_batch', '_row')
+
+    def __init__(self, batch: CorpBatch, row: int):
+        object.__setattr__(self, '_batch', batch)
+        object.__setattr__(self, '_row', row)
+
+    @property
+    def name(self) -> str:
+        return self._batch.name[self._row]
+
+    @property
+    def stock(self) -> str:
+        return self._batch.stock[self._row]
+
+    @property
+    def market(self) -> Market:
+        return self._batch.market[self._row]
+
+    @property
+    def year(self) -> int:
+        return self._batch.year
+
+    @property
+    def quarter(self) -> int:
+        return self._batch.quarter
+
+    def __getattr__(self, field: str):
+        if field not in field_index:
+            raise AttributeError(field)
+        return self._batch.get(self._row, field)
 
-        self.sales = None
-        self.sales_cost = None
-        self.net_income = None
-        self.profit = None
-        self.cash_flow = None
-        self.assets = None
-        self.equity = None
-        self.liabilities = None
-        self.price = None
-        self.shares = None
-        self.equity_issue = 0
-        self.capex_intangible = 0
-        self.capex_property = 0
-
-        self.capex = None
-        self.market_cap = None
-        self.sales_profit = None
-        self.book_value = None
-
-        self.pbr = None
-        self.per = None
-        self.psr = None
-        self.pcr = None
-        self.fcf = None
-        self.pfcr = None
-        self.roa = None
-        self.roe = None
-        self.gpa = None
-
-        self.ipbr = None
-        self.iper= None
-        self.ipsr = None
-        self.ipfcr = None
-        self.ipcr = None
-
-        self.qoq_net_income = None
-        self.qoq_profit = None
-        self.qoq_book_value = None
-        self.qoq_assets = None
-
-        self.yoy_net_income = None
-        self.yoy_profit = None
-
-        self.profit_growth_qoq = None
-        self.profit_growth_yoy = None
-        self.net_income_growth_qoq = None
-        self.net_income_growth_yoy = None
-        self.book_value_growth_qoq = None
-        self.assets_growth_qoq = None
-        
-        # Orders
-        self.ord_ipbr = None
-        self.ord_iper= None
-        self.ord_ipsr = None
-        self.ord_ipfcr = None
-        self.ord_ipcr = None
-        self.ord_profit_growth_qoq = None
-        self.ord_profit_growth_yoy = None
-        self.ord_net_income_growth_qoq = None
-        self.ord_net_income_growth_yoy = None
-        self.ord_book_value_growth_qoq = None
-        self.ord_assets_growth_qoq = None
-        
-        # Scores
-        self.fscore_k = None
\ No newline at end of file
+    def __setattr__(self, field: str, value) -> None:
+        if field not in field_index:
+            raise AttributeError(field)
+        self._batch.set(self._row, field, value)
@@ -0,0 +1,123 @@
+from __future__ import annotations
+from typing import List, Tuple
+import os, shutil, sqlite3
+
+import pandas as pd
+
+import schema
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pa_fs
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# krx table as Parquet files partitioned by year and quarter: {path}/year=2021/quarter=1/krx.parquet
+_parquet_dir = 'halq-parquet'
+_table_name = schema.table_name
+_partitioning = None if pa is None else ds.partitioning(pa.schema([('year', pa.int64()), ('quarter', pa.int64())]), flavor='hive')
+
+# Few distinct values, stored with a dictionary
+_dictionary_columns = {'stock', 'name', 'market'}
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError('pyarrow is required for the Parquet dataset')
+
+
+def _partition_dir(path: str, year: int, quarter: int) -> str:
+    return os.path.join(path, f'year={year}', f'quarter={quarter}')
+
+
+def _arrow_type(col: str, declared: str):
+    if col in _dictionary_columns:
+        return pa.dictionary(pa.int32(), pa.string())
+    if declared == 'TEXT':
+        return pa.string()
+    return pa.int64() if declared == 'INTEGER' else pa.float64()
+
+
+def _quarter_table(conn: sqlite3.Connection, year: int, quarter: int) -> pa.Table:
+    # Types follow the declared SQLite column types
+    declared = {r[1]: r[2].upper() for r in conn.execute(f'PRAGMA table_info({_table_name})')}
+    columns = [c for c in declared if c not in ('index', 'year', 'quarter')]
+    df = pd.read_sql_query(f'SELECT {", ".join(columns)} FROM {_table_name} WHERE year=? AND quarter=? ORDER BY stock', conn, params=(year, quarter))
+    arrays = []
+    for col in columns:
+        type = _arrow_type(col, declared[col])
+        if pa.types.is_dictionary(type):
+            arrays.append(pa.array(df[col], pa.string(), from_pandas=True).dictionary_encode())
+        elif type == pa.int64():
+            arrays.append(pa.array(pd.to_numeric(df[col]).astype('Int64'), type))
+        else:
+            arrays.append(pa.array(df[col], type, from_pandas=True))
+    return pa.Table.from_arrays(arrays, names=columns)
+
+
+def write_quarters(conn: sqlite3.Connection, quarters: List[Tuple[int, int]], path: str = _parquet_dir) -> int:
+    # Rewrites the partitions of the given quarters from halq.db, empty quarters are removed
+    _require_pyarrow()
+    for year, quarter in quarters:
+        table = _quarter_table(conn, year, quarter)
+        part = _partition_dir(path, year, quarter)
+        if table.num_rows == 0:
+            shutil.rmtree(part, ignore_errors=True)
+            continue
+        os.makedirs(part, exist_ok=True)
+        tmp = os.path.join(part, 'krx.parquet.tmp')
+        pq.write_table(table, tmp, use_dictionary=list(_dictionary_columns & set(table.column_names)), compression='zstd')
+        os.replace(tmp, os.path.join(part, 'krx.parquet'))
+    return len(quarters)
+
+
+def quarters(path: str = _parquet_dir) -> List[Tuple[int, int]]:
+    # Exported partitions
+    if not os.path.isdir(path):
+        return []
+    ret = []
+    for y in os.listdir(path):
+        if not y.startswith('year='):
+            continue
+        for q in os.listdir(os.path.join(path, y)):
+            if q.startswith('quarter=') and os.path.exists(os.path.join(path, y, q, 'krx.parquet')):
+                ret.append((int(y[5:]), int(q[8:])))
+    return sorted(ret)
+
+
+def remove(path: str = _parquet_dir) -> None:
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def _quarter_filter(begin: Tuple[int, int], end: Tuple[int, int]):
+    # Expressed on the partition fields only, so whole partitions are skipped
+    expr = None
+    if begin is not None:
+        expr = (ds.field('year') > begin[0]) | ((ds.field('year') == begin[0]) & (ds.field('quarter') >= begin[1]))
+    if end is not None:
+        e = (ds.field('year') < end[0]) | ((ds.field('year') == end[0]) & (ds.field('quarter') <= end[1]))
+        expr = e if expr is None else expr & e
+    return expr
+
+
+def load_table(columns: List[str] = None, begin: Tuple[int, int] = None, end: Tuple[int, int] = None,
+               filter=None, path: str = _parquet_dir) -> pa.Table:
+    # Reads the exported krx dataset with memory-mapped files.
+    # columns: only these columns are read (year and quarter are always available for filtering)
+    # begin, end: (year, quarter) range, partitions outside of it are not opened
+    # filter: additional pyarrow.dataset expression, e.g. ds.field('market') == 'KOSPI'
+    _require_pyarrow()
+    dataset = ds.dataset(path, format='parquet', partitioning=_partitioning, filesystem=pa_fs.LocalFileSystem(use_mmap=True))
+    expr = _quarter_filter(begin, end)
+    if filter is not None:
+        expr = filter if expr is None else expr & filter
+    return dataset.to_table(columns=columns, filter=expr)
+
+
+def load_frame(columns: List[str] = None, begin: Tuple[int, int] = None, end: Tuple[int, int] = None,
+               filter=None, path: str = _parquet_dir) -> pd.DataFrame:
+    # Columns stay backed by Arrow memory (pd.ArrowDtype), no conversion copy is made
+    return load_table(columns, begin, end, filter, path).to_pandas(types_mapper=pd.ArrowDtype)
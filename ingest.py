@@ -0,0 +1,234 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterator, List, Tuple
+import io, os, pickle, time
+import multiprocessing
+from queue import Queue
+
+import pandas as pd
+
+from corp import CorpBatch
+import catalog
+import instrument
+import krx
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+# Parsing a DART file takes a few hundred MB at most, workers are bounded by CPUs and available memory
+_worker_memory = 512 * 1024 * 1024
+
+
+def _available_memory() -> int:
+    try:
+        with open('/proc/meminfo', 'r') as fin:
+            for line in fin:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def default_workers() -> int:
+    # FIN_DATA_WORKERS overrides the number of worker processes
+    if os.environ.get('FIN_DATA_WORKERS'):
+        return max(1, int(os.environ['FIN_DATA_WORKERS']))
+    workers = multiprocessing.cpu_count()
+    memory = _available_memory()
+    if memory is not None:
+        workers = min(workers, memory // _worker_memory)
+    return max(1, workers)
+
+
+def _to_ipc(frames: List[pd.DataFrame]) -> List[bytes]:
+    # Parsed frames are sent back from workers as Arrow IPC streams, pickled without pyarrow
+    if pa is None:
+        return [pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL) for df in frames]
+    out = []
+    for df in frames:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        sink = io.BytesIO()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        out.append(sink.getvalue())
+    return out
+
+
+def _from_ipc(buffers: List[bytes]) -> List[pd.DataFrame]:
+    if pa is None:
+        return [pickle.loads(b) for b in buffers]
+    return [pa.ipc.open_stream(b).read_all().to_pandas() for b in buffers]
+
+
+def _files(year: int, quarter: int) -> List[Tuple]:
+    # Tasks of a quarter in merging order, None for Stocks.csv
+    return [(year, quarter, t, con) for t, con in krx.statement_files] + [(year, quarter, None, None)]
+
+
+def _parse(task: Tuple) -> Tuple:
+    year, quarter, type, con = task
+    if type is None:
+        return list(krx.parse_shares(year, quarter))
+    return list(krx.parse_statement(year, quarter, type, con))
+
+
+def _filename(task: Tuple) -> str:
+    year, quarter, type, con = task
+    return f'{year}-{quarter}Q-Stocks.csv' if type is None else krx.get_filename(year, quarter, type, con)
+
+
+def _parse_task(task: Tuple) -> Tuple:
+    # Runs in a worker, exceptions are returned so that only the rows of the file are lost.
+    # Stages recorded in the worker are returned with the result when instrumented.
+    try:
+        with instrument.stage('ingest.parse'):
+            buffers = _to_ipc(_parse(task))
+        return task, buffers, None, instrument.snapshot() if instrument.enabled else None
+    except Exception as e:
+        return task, None, f'{type(e).__name__}: {e}', instrument.snapshot() if instrument.enabled else None
+
+
+_lost = 'worker process died'
+
+
+def _result(task: Tuple, future: Future) -> Tuple:
+    # Result of a task run by the pool. The task of a worker that died (killed for memory) is lost, and with it
+    # every task of the pool still pending: the pool is broken.
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        return task, None, _lost, None
+    except Exception as e:
+        return task, None, f'{type(e).__name__}: {e}', None
+
+
+def _merge(year: int, quarter: int, parsed: Dict[Tuple, List[pd.DataFrame]], errors: Dict[Tuple, str]) -> CorpBatch:
+    # Files that failed to parse are recorded as issues and only their rows are missing
+    corps = CorpBatch(year, quarter)
+    for task in _files(year, quarter):
+        if task in errors:
+            corps.failed.append(_filename(task))
+            corps.add_issues(krx.unreadable(_filename(task), errors[task]))
+        elif task[2] is None:
+            krx.merge_shares(corps, tuple(parsed[task]))
+        else:
+            krx.merge_statement(corps, task[2], tuple(parsed[task]))
+    return corps
+
+
+def load_quarters(tlist: List[Tuple[int, int]], workers: int = None, use_cache: bool = True) -> Iterator[CorpBatch]:
+    # Yields the CorpBatch of each quarter as soon as all of its files are parsed.
+    # Cached quarters come first, files of the others are parsed in parallel, one task per file,
+    # a few quarters at a time.
+    # A file that fails to parse only loses its own rows, quarters that fail to merge are reported and skipped.
+    entries = catalog.scan() if use_cache else None
+    pending = []
+    for year, quarter in tlist:
+        with instrument.stage('ingest.cache') as s:
+            cached = krx.load_cache(year, quarter, entries) if use_cache else None
+            s.rows = len(cached) if cached is not None else 0
+        if cached is not None:
+            yield cached
+        else:
+            pending.append((year, quarter))
+    if len(pending) == 0:
+        return
+
+    # Signatures are taken before parsing so that a file edited meanwhile invalidates the cache
+    sigs = {t: krx.source_signature(*t, entries) for t in pending} if use_cache else {}
+    tasks = len(pending) * len(_files(*pending[0]))
+    remaining = {t: len(_files(*t)) for t in pending}
+    parsed: Dict[Tuple[int, int], Dict] = {t: {} for t in pending}
+    errors: Dict[Tuple[int, int], Dict] = {t: {} for t in pending}
+
+    if workers is None:
+        workers = default_workers()
+    workers = min(workers, tasks)
+
+    # Files of only a few quarters are in flight so that parsed data of at most that many quarters is held
+    window = max(2, -(-workers // len(_files(*pending[0]))) + 1)
+    queue = list(pending)
+    # (result, pool that ran the task)
+    done = Queue()
+    # Quarters that lost a task to a dead worker, skipped and loaded again next time
+    lost = set()
+
+    def new_pool():
+        # Workers start without the records inherited from this process
+        return ProcessPoolExecutor(workers, initializer=instrument.reset) if workers > 1 else None
+
+    def submit(t):
+        nonlocal pool
+        for task in _files(*t):
+            if pool is not None:
+                try:
+                    future = pool.submit(_parse_task, task)
+                except BrokenProcessPool:
+                    # Broken since its lost tasks were received
+                    pool = new_pool()
+                    future = pool.submit(_parse_task, task)
+                future.add_done_callback(lambda f, task=task, p=pool: done.put((_result(task, f), p)))
+            else:
+                done.put((_parse_task(task), None))
+
+    pool = new_pool()
+    instrument.count('ingest.workers', workers)
+    instrument.count('ingest.tasks', tasks)
+    start = time.perf_counter()
+    try:
+        for _ in range(min(window, len(queue))):
+            submit(queue.pop(0))
+        while len(remaining) > 0:
+            with instrument.stage('ingest.wait'):
+                (task, buffers, error, stats), ran = done.get()
+            instrument.merge(stats)
+            t = task[:2]
+            remaining[t] -= 1
+            if error == _lost:
+                lost.add(t)
+                # Quarters submitted later go to a new pool
+                if ran is pool:
+                    print('A worker died, restarting the workers')
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = new_pool()
+            elif error is not None:
+                print(f'Failed to parse {_filename(task)}: {error}')
+                errors[t][task] = error
+            else:
+                with instrument.stage('ingest.decode'):
+                    parsed[t][task] = _from_ipc(buffers)
+            if remaining[t] > 0:
+                continue
+
+            del remaining[t]
+            if len(queue) > 0:
+                submit(queue.pop(0))
+            files = parsed.pop(t)
+            failed = errors.pop(t)
+            if t in lost:
+                print(f'Failed to load {t[0]}-{t[1]}Q: {_lost}')
+                continue
+            try:
+                with instrument.stage('ingest.merge') as s:
+                    corps = _merge(*t, files, failed)
+                    s.rows = len(corps)
+                del files
+                # Quarters with quarantined files are parsed again next time
+                if use_cache and len(failed) == 0:
+                    with instrument.stage('ingest.save_cache'):
+                        krx.save_cache(*t, corps, sigs[t])
+            except Exception as e:
+                print(f'Failed to load {t[0]}-{t[1]}Q: {type(e).__name__}: {e}')
+                continue
+            yield corps
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if instrument.enabled:
+            # Share of the worker time spent parsing, including the time the consumer held the generator
+            busy = instrument.total('ingest.parse')
+            instrument.count('ingest.worker_utilization', round(busy / (workers * (time.perf_counter() - start)), 4))
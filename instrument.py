@@ -0,0 +1,154 @@
+from typing import Dict
+import cProfile
+import functools
+import json
+import os, sys
+import time
+
+# Stage timings and counters of a build, emitted as JSON.
+# Off unless FIN_DATA_PROFILE is set (to 1 for stderr or to a JSON file) or enable() is called. When off, stage()
+# returns a shared no-op object and the other calls return at once. FIN_DATA_CPROFILE=file also dumps cProfile stats.
+_env = 'FIN_DATA_PROFILE'
+_cprofile_env = 'FIN_DATA_CPROFILE'
+
+enabled = bool(os.environ.get(_env))
+
+_stages: Dict[str, list] = {}               # name -> [calls, wall seconds, cpu seconds, rows]
+_counters: Dict[str, float] = {}
+_files: Dict[str, Dict[str, float]] = {}    # filename -> rows parsed, skipped, invalid, ...
+
+
+class _Stage:
+    __slots__ = ('name', 'rows', '_wall', '_cpu')
+
+    def __init__(self, name: str, rows: int):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        s = _stages.setdefault(self.name, [0, 0.0, 0.0, 0])
+        s[0] += 1
+        s[1] += time.perf_counter() - self._wall
+        s[2] += time.process_time() - self._cpu
+        s[3] += self.rows or 0
+        return False
+
+
+class _NoStage:
+    # Accepts rows like _Stage and records nothing
+    __slots__ = ('rows',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_stage = _NoStage()
+
+
+def enable(output: str = None) -> None:
+    # Also set in the environment so that worker processes record their stages
+    global enabled
+    enabled = True
+    os.environ[_env] = output or os.environ.get(_env) or '1'
+
+
+def stage(name: str, rows: int = None):
+    # with instrument.stage('insert') as s: ...; s.rows = n
+    if not enabled:
+        return _no_stage
+    return _Stage(name, rows)
+
+
+def count(name: str, n: float = 1) -> None:
+    if enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def total(name: str) -> float:
+    # Wall seconds of a stage recorded so far, 0 if it did not run
+    s = _stages.get(name)
+    return s[1] if s is not None else 0.0
+
+
+def file_stats(filename: str, **stats) -> None:
+    if enabled:
+        f = _files.setdefault(filename, {})
+        for k, v in stats.items():
+            f[k] = f.get(k, 0) + v
+
+
+def reset() -> None:
+    _stages.clear()
+    _counters.clear()
+    _files.clear()
+
+
+def snapshot() -> Dict:
+    # Records of this process since the last snapshot, sent back from workers and merged
+    ret = {'stages': {k: list(v) for k, v in _stages.items()}, 'counters': dict(_counters), 'files': {k: dict(v) for k, v in _files.items()}}
+    reset()
+    return ret
+
+
+def merge(snap: Dict) -> None:
+    if not enabled or snap is None:
+        return
+    for name, v in snap['stages'].items():
+        s = _stages.setdefault(name, [0, 0.0, 0.0, 0])
+        for i in range(4):
+            s[i] += v[i]
+    for name, n in snap['counters'].items():
+        count(name, n)
+    for filename, stats in snap['files'].items():
+        file_stats(filename, **stats)
+
+
+def report(name: str, wall: float) -> Dict:
+    return {
+        'name': name,
+        'wall_seconds': round(wall, 6),
+        'stages': [{'name': k, 'calls': v[0], 'wall_seconds': round(v[1], 6), 'cpu_seconds': round(v[2], 6), 'rows': v[3]} for k, v in _stages.items()],
+        'counters': _counters,
+        'files': _files,
+    }
+
+
+def emit(name: str, wall: float) -> None:
+    output = os.environ.get(_env, '1')
+    text = json.dumps(report(name, wall), ensure_ascii=False, indent=1)
+    if output == '1':
+        print(text, file=sys.stderr)
+    else:
+        with open(output, 'w', encoding='utf-8') as fout:
+            fout.write(text)
+
+
+def profiled(fn):
+    # Records and emits the stages of each call of fn when enabled, under cProfile when FIN_DATA_CPROFILE is set
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        cprofile = os.environ.get(_cprofile_env)
+        if not enabled and not cprofile:
+            return fn(*args, **kwargs)
+
+        reset()
+        profile = cProfile.Profile() if cprofile else None
+        start = time.perf_counter()
+        try:
+            if profile is not None:
+                return profile.runcall(fn, *args, **kwargs)
+            return fn(*args, **kwargs)
+        finally:
+            if profile is not None:
+                profile.dump_stats(cprofile)
+            if enabled:
+                emit(fn.__name__, time.perf_counter() - start)
+    return wrapper
@@ -1,349 +1,495 @@
 from typing import Dict, List
 from xxlimited import Str
-from corp import Market, Corp
-import re, json, os, traceback
+from corp import Market, CorpBatch
+import accounts
+import archive
+import catalog
+import instrument
+import corp
+import hashlib, io, re, os
+import csv
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = pa_csv = None
 
 
 # http://data.krx.co.kr/contents/MDC/MDI/mdiLoader/index.cmd?menuId=MDC0201020101
 
-# 매출액
-_dart_code_sales1 = 'ifrs_Revenue'
-_dart_code_sales2 = 'ifrs-full_Revenue'
+# DART account codes and names are listed in accounts.taxonomy
 
-# 매출원가
-_dart_code_sales_cost1 = 'ifrs_CostOfSales'
-_dart_code_sales_cost2 = 'ifrs-full_CostOfSales'
+_dart_kospi_title = '유가증권시장상장법인'
+_dart_kosdaq_title = '코스닥시장상장법인'
 
-# 당기순이익
-_dart_code_net_income1 = 'ifrs_ProfitLoss'
-_dart_code_net_income2 = 'ifrs-full_ProfitLoss'
 
+_dart_markets = {_dart_kospi_title: Market.KOSPI, _dart_kosdaq_title: Market.KOSDAQ}
+
+# Columns of DART TSV files
+_col_stock = 1
+_col_name = 2
+_col_market = 3
+_col_code = 10
+_col_account = 11
+
+
+# Interim reports label the amounts like
+#   PL  '당기 반기 3개월', '당기 반기 누적', '전기 반기 3개월', '전기 반기 누적', '전기', '전전기'
+#   CF  '당기 반기', '전기 반기', '전기', '전전기'
+#   BS  '당기 반기말', '전기말', '전전기말'
+# and annual reports '당기', '전기', '전전기', whose current year is also the year to date
+# and whose previous year is also the same period of the previous year.
+_interim = re.compile('[분반]기')
+
+
+def _value_columns(filename: str, periods: List[str], value_index: int = None) -> Dict[str, int]:
+    # Column of the current amount ('value') and of each of periods (see accounts.periods) found in the header.
+    # Some files have an empty header column before the amounts.
+    if value_index is not None and len(periods) == 0:
+        return {'value': value_index}
+    fin, encoding = archive.open_binary('dart-data', filename)
+    with fin:
+        header = [' '.join(h.split()) for h in fin.readline().decode(encoding).split('\t')]
+    if value_index is None:
+        value_index = 13 if len(header[12]) == 0 else 12
+
+    labels = header[value_index:]
+    annual = not any(_interim.search(h) for h in labels)
+    columns = {'value': value_index}
+    for i, h in enumerate(labels, value_index):
+        if h.startswith('당기'):
+            found = ['ytd'] if '누적' in h or '3개월' not in h else []
+        elif not h.startswith('전기'):
+            found = []
+        elif '누적' in h:
+            found = ['prior_ytd']
+        elif '3개월' in h:
+            found = ['prior']
+        elif annual:
+            found = ['prior', 'prior_ytd', 'prior_fy']
+        elif _interim.search(h):
+            found = ['prior', 'prior_ytd']
+        else:
+            found = ['prior_fy']
+        for p in found:
+            if p in periods:
+                columns.setdefault(p, i)
+    return columns
+
+
+def _read_columns(filename: str, value_columns: List[int]) -> pd.DataFrame:
+    # Text columns are read as categoricals so that each distinct value is processed once
+    cols = [_col_stock, _col_name, _col_market, _col_code, _col_account]
+    if pa_csv is not None:
+        names = [f'f{i}' for i in cols + value_columns]
+        types = {n: pa.dictionary(pa.int32(), pa.string()) for n in names[:len(cols)]}
+        types.update({n: pa.string() for n in names[len(cols):]})
+        skipped = []
+
+        def skip(row) -> str:
+            skipped.append(row.text)
+            return 'skip'
+
+        fin, encoding = archive.open_binary('dart-data', filename)
+        with fin:
+            table = pa_csv.read_csv(
+                fin,
+                read_options=pa_csv.ReadOptions(skip_rows=1, autogenerate_column_names=True, encoding=encoding),
+                parse_options=pa_csv.ParseOptions(delimiter='\t', quote_char=False, invalid_row_handler=skip),
+                convert_options=pa_csv.ConvertOptions(include_columns=names, column_types=types, include_missing_columns=True))
+        # Amounts stay in Arrow until the needed rows are known
+        df = table.drop_columns(names[len(cols):]).to_pandas()
+        df.columns = cols
+        for i, n in zip(value_columns, names[len(cols):]):
+            df[i] = pd.arrays.ArrowExtensionArray(table.column(n))
+        df.attrs['skipped'] = skipped
+        return df
+
+    dtype = {c: 'category' for c in cols}
+    dtype.update({i: object for i in value_columns})
+    fin, encoding = archive.open_binary('dart-data', filename)
+    with fin:
+        return pd.read_csv(fin, sep='\t', header=None, skiprows=1, usecols=cols + value_columns, dtype=dtype,
+                           quoting=csv.QUOTE_NONE, keep_default_na=False, na_filter=False, encoding=encoding)
+
+
+def _malformed(filename: str, rows: List[str]) -> pd.DataFrame:
+    # Issues of rows skipped by the CSV reader, stock and account are taken where the row has them
+    cells = [r.split('\t') for r in rows]
+    return pd.DataFrame({
+        'file': filename,
+        'stock': [c[_col_stock].strip()[1:-1].strip() if len(c) > _col_stock else None for c in cells],
+        'account': [c[_col_account].strip() if len(c) > _col_account else None for c in cells],
+        'value': [r[:200] for r in rows],
+        'reason': 'malformed row',
+    }, columns=corp.issue_columns)
+
+
+def unreadable(filename: str, error: str) -> pd.DataFrame:
+    # Issue of a file that could not be parsed, none of its rows are loaded
+    return pd.DataFrame({'file': [filename], 'stock': [None], 'account': [None], 'value': [None], 'reason': [f'unreadable file: {error}']})
+
+
+def _categories(s: pd.Series, fn) -> tuple:
+    # Row codes and transformed categories of a categorical column
+    return s.cat.codes.to_numpy(), np.array([fn(str(c)) for c in s.cat.categories], dtype=object)
+
+
+# Field index -> index of its {field}_{period} field, -1 if the field has no such period
+_period_index = {p: np.array([corp.field_index.get(f'{f}_{p}', -1) for f in corp.fields], dtype=np.int64)
+                 for p in set(p for ps in accounts.periods.values() for p in ps)}
+
+
+def _amounts(s: pd.Series) -> tuple:
+    # Amounts and the raw text of the cells, invalid ones (not a whole number) are NaN and flagged
+    raw = s.fillna('').to_numpy().astype(str)
+    text = np.char.replace(np.char.strip(raw), ',', '')
+    value = pd.to_numeric(pd.Series(text, dtype=object), errors='coerce').to_numpy(dtype=np.float64, copy=True)
+    invalid = (np.isnan(value) & (text != '')) | (~np.isnan(value) & (value != np.round(value)))
+    reason = np.where(np.isnan(value), 'not a number', 'not an integer')
+    value[invalid] = np.nan
+    return value, raw, invalid, reason
+
+
+def _read_dart(filename: str, lookup: Dict[str, tuple], periods: List[str] = (), value_index: int = None) -> tuple:
+    # Returns the first row of each listed corporation (stock, name, market),
+    # the rows of mapped accounts (stock, field, priority, value) and the issues found (see corp.issue_columns).
+    # Amounts of the other periods in the header are rows of the {field}_{period} fields.
+    # Rows are mapped by account code first, then by normalized account name.
+    # Account names keep only Korean letters and parentheses, empty or invalid amounts are NaN.
+    columns = _value_columns(filename, periods, value_index)
+    raw = _read_columns(filename, sorted(set(columns.values())))
+
+    market_codes, markets = _categories(raw[_col_market], lambda v: _dart_markets.get(v.strip()))
+    listed = np.array([m is not None for m in markets], dtype=bool)[market_codes]
+
+    stock_codes, stocks = _categories(raw[_col_stock], lambda v: v[1:-1].strip())
+    name_codes, names = _categories(raw[_col_name], str.strip)
+    code_codes, codes = _categories(raw[_col_code], str.strip)
+    account_codes, account_names = _categories(raw[_col_account], lambda v: re.sub('[^()가-힣]', '', v))
+
+    # (field index, priority) of each distinct code and name, -1 if not mapped
+    def mapped(keys):
+        hits = [lookup.get(k, (None, -1)) for k in keys]
+        return np.array([-1 if f is None else corp.field_index[f] for f, _ in hits], dtype=np.int64), np.array([p for _, p in hits], dtype=np.int64)
+    code_field, code_priority = mapped(codes)
+    name_field, name_priority = mapped(account_names)
+    by_code = code_field[code_codes] >= 0
+    field = np.where(by_code, code_field[code_codes], name_field[account_codes])
+    priority = np.where(by_code, code_priority[code_codes], name_priority[account_codes])
+
+    # First appearance of each listed corporation
+    listed_rows = np.flatnonzero(listed)
+    _, first = np.unique(stock_codes[listed_rows], return_index=True)
+    first = listed_rows[np.sort(first)]
+    corps = pd.DataFrame({'stock': stocks[stock_codes[first]], 'name': names[name_codes[first]], 'market': markets[market_codes[first]]})
+
+    rows = np.flatnonzero(listed & (field >= 0))
+    stock = stocks[stock_codes[rows]]
+    frames, issues, amounts = [], [], {}
+    for period, col in columns.items():
+        target = field[rows] if period == 'value' else _period_index[period][field[rows]]
+        # A column shared by several periods is parsed and reported once
+        if col not in amounts:
+            value, text, invalid, reason = amounts[col] = _amounts(raw[col].iloc[rows])
+            bad = np.flatnonzero(invalid)
+            issues.append(pd.DataFrame({
+                'file': filename,
+                'stock': stock[bad],
+                'account': account_names[account_codes[rows[bad]]],
+                'value': text[bad],
+                'reason': reason[bad] if period == 'value' else np.char.add(reason[bad].astype(str), f' ({period})'),
+            }, columns=corp.issue_columns))
+        frames.append(pd.DataFrame({'stock': stock, 'field': target, 'priority': priority[rows], 'value': amounts[col][0]}))
+    invalid = sum(len(i) for i in issues)
+
+    skipped = raw.attrs.get('skipped', [])
+    if len(skipped) > 0:
+        issues.append(_malformed(filename, skipped))
+    issues = pd.concat(issues, ignore_index=True)
+    if len(issues) > 0:
+        print(f'{filename}: {invalid} invalid values, {len(skipped)} malformed rows')
+    if instrument.enabled:
+        instrument.file_stats(filename, rows=len(raw), skipped=len(skipped), listed=int(listed.sum()), mapped=len(rows), invalid=invalid)
+
+    df = pd.concat(frames, ignore_index=True)
+    return corps, df[df['field'] >= 0], issues
+
+
+def _add_corps(corps: CorpBatch, listed: pd.DataFrame) -> None:
+    # Corporations are created in the order they first appear
+    for stock, name, market in zip(listed['stock'], listed['name'], listed['market']):
+        if stock not in corps.index:
+            corps.add(name, stock, Market(market))
+
+
+def _set_fields(corps: CorpBatch, df: pd.DataFrame) -> None:
+    # Per corporation and field, the row with the highest priority wins, then the last one in the file
+    rows = df['stock'].map(corps.index)
+    df = df[rows.notna() & df['value'].notna()]
+    if len(df) == 0:
+        return
+    row = rows[df.index].to_numpy().astype(np.int64)
+    field = df['field'].to_numpy()
+    order = np.lexsort((-np.arange(len(df)), df['priority'].to_numpy(), row, field))
+    key = field[order] * len(corps) + row[order]
+    best = order[np.r_[True, key[1:] != key[:-1]]]
+    corps.values[field[best], row[best]] = df['value'].to_numpy()[best]
+
+
+# Statements whose rows add corporations, the others only fill in existing ones
+_creating_statements = ['PL', 'CPL', 'CF']
+
+# Statements whose amounts are always in column 12
+_fixed_value_index = {'CE': 12}
+
+
+def parse_statement(year: int, quarter: int, type: str, con: bool) -> tuple:
+    return _read_dart(get_filename(year, quarter, type, con), accounts.lookups[type], accounts.periods[type], _fixed_value_index.get(type))
+
+
+def merge_statement(corps: CorpBatch, type: str, parsed: tuple) -> None:
+    listed, df, issues = parsed
+    if type in _creating_statements:
+        _add_corps(corps, listed)
+    _set_fields(corps, df)
+    corps.add_issues(issues)
+
+
+# Columns of KRX stock files by header, and their positions in files without one
+_stock_columns = {'stock': ('종목코드', 0), 'market': ('시장구분', 2), 'price': ('종가', 4), 'shares': ('상장주식수', -1)}
+
+
+def read_stocks(text: str, filename: str) -> tuple:
+    # Returns (stock, market, price, shares) of the KOSPI and KOSDAQ rows of a KRX stock file and the issues found.
+    # Fields are quoted CSV, numbers may have thousands separators.
+    rows = list(csv.reader(io.StringIO(text)))
+    header = [h.strip() for h in rows[0]] if len(rows) > 0 else []
+    if _stock_columns['stock'][0] in header:
+        index = {k: header.index(h) if h in header else i for k, (h, i) in _stock_columns.items()}
+        rows = rows[1:]
+    else:
+        index = {k: i for k, (_, i) in _stock_columns.items()}
+
+    stocks, markets, prices, shares = [], [], [], []
+    invalid = []
+    for data in rows:
+        if len(data) < 3:
+            continue
+        stock = data[index['stock']].strip()
+        market = data[index['market']].strip().upper()
+        if market != 'KOSPI' and market != 'KOSDAQ':
+            continue
+
+        try:
+            price = int(data[index['price']].strip().replace(',', ''))
+            share = int(data[index['shares']].strip().replace(',', ''))
+        except (ValueError, IndexError):
+            invalid.append((stock, ','.join(data)[:200]))
+            continue
+        stocks.append(stock)
+        markets.append(market)
+        prices.append(price)
+        shares.append(share)
+    issues = pd.DataFrame({'file': filename, 'stock': [i[0] for i in invalid], 'account': 'price, shares', 'value': [i[1] for i in invalid],
+                           'reason': 'not an integer'}, columns=corp.issue_columns)
+    if len(issues) > 0:
+        print(f'{filename}: {len(issues)} invalid rows')
+    return pd.DataFrame({'stock': stocks, 'market': markets, 'price': np.array(prices, dtype=np.float64),
+                         'shares': np.array(shares, dtype=np.float64)}), issues
+
+
+def parse_shares(year: int, quarter: int) -> tuple:
+    # Returns (stock, price, shares) of KOSPI and KOSDAQ stocks and the issues found
+    filename = f'{year}-{quarter}Q-Stocks.csv'
+    with open('dart-data/' + filename, 'rb') as fin:
+        df, issues = read_stocks(archive.decode(fin.read()), filename)
+    return df[['stock', 'price', 'shares']], issues
+
+
+def merge_shares(corps: CorpBatch, parsed: tuple) -> None:
+    df, issues = parsed
+    rows = df['stock'].map(corps.index)
+    found = rows.notna().to_numpy()
+    rows = rows[found].to_numpy().astype(np.int64)
+    corps.values[corp.field_index['price'], rows] = df['price'].to_numpy()[found]
+    corps.values[corp.field_index['shares'], rows] = df['shares'].to_numpy()[found]
+    corps.add_issues(issues)
+
+
+# Statement files of a quarter in loading order
+statement_files = [(t, con) for t in accounts.statements for con in (False, True)]
 
-# 영업이익
-_dart_code_profit1 = 'dart_OperatingIncomeLoss'
 
+def get_filename(year, quarter, type, c):
+    return archive.filename(year, quarter, type, c)
 
-# 자산총계
-_dart_code_assets1 = 'ifrs_Assets'
-_dart_code_assets2 = 'ifrs-full_Assets'
 
-# 자본총계
-_dart_code_equity1 = 'ifrs_Assets'
-_dart_code_equity2 = 'ifrs-full_Assets'
+def data_exists(year: int, quarter: int, entries: Dict[str, catalog.Entry] = None) -> bool:
+    # Pass the entries of one catalog.scan() when checking several quarters, each call without them scans dart-data
+    return catalog.complete(catalog.scan() if entries is None else entries, year, quarter)
 
-# 유상증자
-_dart_code_euqity_issue1 = 'ifrs-full_IssueOfEquity'
-_dart_code_euqity_issue2 = 'ifrs_IssueOfEquity'
 
-# 현금흐름
-_dart_code_cash_flow1 = 'ifrs_CashFlowsFromUsedInOperatingActivities'
-_dart_code_cash_flow2 = 'ifrs-full_CashFlowsFromUsedInOperatingActivities'
+# Parsed-quarter cache
+_cache_dir = 'dart-cache'
+_cache_version = 6
 
-# 부채총계
-_dart_code_liabilities1 = 'ifrs_Liabilities'
-_dart_code_liabilities2 = 'ifrs-full_Liabilities'
 
-# 무형자산의 취득
-_dart_code_capex1 = 'ifrs_PurchaseOfIntangibleAssetsClassifiedAsInvestingActivities'
-_dart_code_capex2 = 'ifrs-full_PurchaseOfIntangibleAssetsClassifiedAsInvestingActivities'
+def _cache_filename(year: int, quarter: int) -> str:
+    return f'{_cache_dir}/{year}-{quarter}Q.npz'
 
-# 유형자산의 취득
-_dart_code_capex3 = 'ifrs_PurchaseOfPropertyPlantAndEquipmentClassifiedAsInvestingActivities'
-_dart_code_capex4 = 'ifrs-full_PurchaseOfPropertyPlantAndEquipmentClassifiedAsInvestingActivities'
 
-_dart_kospi_title = '유가증권시장상장법인'
-_dart_kosdaq_title = '코스닥시장상장법인'
+def source_signature(year: int, quarter: int, entries: Dict[str, catalog.Entry] = None) -> Dict[str, tuple]:
+    # name -> (size, mtime_ns, hash) from the dart-data catalog
+    return catalog.signature(catalog.scan() if entries is None else entries, year, quarter)
 
 
-def _load_pl(year: int, quarter: int, cpl: bool, con: bool, corps: Dict[str, Corp]):
-    type = 'CPL' if cpl else 'PL'
-    filename = get_filename(year, quarter, type, con)
-
-    # print(f', Reading {filename}')
-    # Sales, Net-Income
-    with open('dart-data/' + filename, 'r', encoding='utf-8') as fin:
-        fields = fin.readline().split('\t')
-        # print(f'Reading {filename}, fields: {len(fields)}')
-        value_index = 12
-        if len(fields[12].strip()) == 0:
-            value_index = 13                
-                
-        for line in fin:
-            data = line.split('\t')
-            type = data[3].strip()
-            field = data[11].strip()
-            field = re.sub('[^()가-힣]', '', field)
-            field_code = data[10].strip()
-
-            value = data[value_index].strip()
-            stock = data[1][1:-1]
-
-            if type == _dart_kosdaq_title or type == _dart_kospi_title:
-                name = data[2].strip()
-                market = Market.KOSDAQ if type == _dart_kosdaq_title else Market.KOSPI
-                
-                if stock not in corps:
-                    corps[stock] = Corp(name, stock, market, year, quarter)
-                c = corps[stock]
-
-                if value is None or len(value) == 0:
-                    continue
-                
-                try:
-                    value = int(value.replace(',', ''))
-                    if field == '당기순이익' or field == '당기순이익(손실)' or field == '분기순이익' or field == '분기순이익(손실)' or field_code == _dart_code_net_income1 or field_code == _dart_code_net_income2:
-                        c.net_income = value
-                    elif field == '매출액' or field == "매출" or field == '수익(매출액)' or field_code == _dart_code_sales1 or field_code == _dart_code_sales2:
-                        c.sales = value
-                    elif field == '매출원가' or field_code == _dart_code_sales_cost1 or field_code == _dart_code_sales_cost2:
-                        c.sales_cost = value
-                    elif field == '영업이익(손실)' or field == '영업이익' or field == '영업손실' or field_code == _dart_code_profit1:
-                        c.profit = value
-                except ValueError:
-                    traceback.print_stack()
-                    print('Invalid', c.name, field, value)
-                    # del corps[stock]
-
-
-def _load_cf(year: int, quarter: int, con: bool, corps):
-    filename = get_filename(year, quarter, 'CF', con)
-    with open('dart-data/' + filename, 'r', encoding='utf-8') as fin:    
-        fields = fin.readline().split('\t')
-        # print(f'Reading {filename}, fields: {len(fields)}')
-        value_index = 12
-        if len(fields[12].strip()) == 0:
-            value_index = 13     
-        for line in fin:
-            data = line.split('\t')
-            type = data[3].strip()
-            field = data[11].strip().replace("'", '').replace('"', '')
-            field = re.sub('[^()가-힣]', '', field)
-            field_code = data[10].strip()
-            stock = data[1][1:-1].strip()
-            value = data[value_index].strip()
-
-            if type == _dart_kosdaq_title or type == _dart_kospi_title:            
-                name = data[2].strip()
-                market = Market.KOSDAQ if type == _dart_kosdaq_title else Market.KOSPI
-                
-                if stock not in corps:
-                    corps[stock] = Corp(name, stock, market, year, quarter)
-                c = corps[stock]
-
-                if value is None or len(value) == 0:
-                    continue
-                val = int(value.replace(',', ''))
-                assert val is not None
-                try:
-                    if field == '영업활동현금흐름' or field == '영업활동으로인한현금흐름' or field_code == _dart_code_cash_flow1 or field_code == _dart_code_cash_flow2:
-                        c.cash_flow = val
-                    # elif field == '무형자산의취득' or field_code == _dart_code_capex1:
-                    elif field == '무형자산의취득' or field_code == _dart_code_capex1 or field_code == _dart_code_capex2:
-                        # if c.capex_intangible is not None:
-                        #    print('Capex-Intangible is already set:', c.stock, c.name, c.capex_intangible, val)
-                        c.capex_intangible = val
-                    # elif field == '유형자산의취득' or field_code == _dart_code_capex2:
-                    elif field == '유형자산의취득' or field_code == _dart_code_capex3 or field_code == _dart_code_capex4:
-                        # if c.capex_property is not None:
-                        #    print('Capex-Property is already set:', c.stock, c.name, c.capex_property, val)
-                        c.capex_property = val
-                except ValueError:
-                    traceback.print_stack()
-                    print('Invalid', c.name, field, value)
-                    # del corps[stock]
-
-
-def _load_bs(year: int, quarter: int, con: bool, corps: Dict[str, Corp]):        
-    filename = get_filename(year, quarter, 'BS', con)
-    with open('dart-data/' + filename, 'r', encoding='utf-8') as fin:    
-        fields = fin.readline().split('\t')
-        # print(f'Reading {filename}, fields: {len(fields)}')
-        value_index = 12
-        if len(fields[12].strip()) == 0:
-            value_index = 13        
-        for line in fin:
-            data = line.split('\t')
-            type = data[3].strip()
-            field = data[11].strip()
-            field_code = data[10].strip()
-            stock = data[1][1:-1]
-            value = data[value_index].strip()
-
-            if type == _dart_kosdaq_title or type == _dart_kospi_title:
-                if stock not in corps:
-                    continue
-
-                c = corps[stock]
-
-                if value is None or len(value) == 0:
-                    continue
-                
-                try:
-                    value = int(value.replace(',', ''))
-                    if field == '자산총계' or field_code == _dart_code_assets1 or field_code == _dart_code_assets2:
-                        c.assets = value
-                    if field == '자본총계' or field_code == _dart_code_equity1 or field_code == _dart_code_equity2:
-                        c.equity = value
-                    elif field == '부채총계' or field_code == _dart_code_liabilities1 or field_code == _dart_code_liabilities2:
-                        c.liabilities = value
-                    #if field == '자본총계':
-                    #    c.book_value = value
-                except ValueError:
-                    traceback.print_stack()
-                    print('Invalid', filename, c.name, field, value)
-                    # del corps[stock]
-
-import sys
-def _load_ce(year: int, quarter: int, con: bool, corps: Dict[str, Corp]):        
-    filename = get_filename(year, quarter, 'CE', con)
-    with open('dart-data/' + filename, 'r', encoding='utf-8') as fin:    
-        fields = fin.readline().split('\t')
-        # print(f'Reading {filename}, fields: {len(fields)}')
-        value_index = 12
-        for line in fin:
-            data = line.split('\t')
-            type = data[3].strip()
-            field = data[11].strip()
-            field_code = data[10].strip()
-            stock = data[1][1:-1]
-            value = data[value_index].strip()
-
-            if type == _dart_kosdaq_title or type == _dart_kospi_title:
-                if stock not in corps:
-                    continue
-
-                c = corps[stock]
-
-                if value is None or len(value) == 0:
-                    continue
-                
-                try:
-                    value = int(value.replace(',', ''))
-                    if field_code == _dart_code_euqity_issue1 or field_code == _dart_code_euqity_issue2:
-                        c.equity_issue = value
-                except ValueError:
-                    pass
-
-
-def _load_shares(filename, corps):
-    with open('dart-data/' + filename, 'r', encoding='utf-8') as fin:    
-        # print(f'Reading {filename}')        
-        for line in fin:
-            data = line.split(',')
-            stock = data[0].strip().replace('"', '')
-            market = data[2].strip().lower().replace('"', '')
-
-            if market != 'kospi' and market != 'kosdaq':
-                continue
+def quarter_signature(year: int, quarter: int, entries: Dict[str, catalog.Entry] = None) -> str:
+    # Source files and account mapping of a quarter
+    sources = catalog.digest(catalog.scan() if entries is None else entries, year, quarter)
+    return hashlib.sha1(f'{sources};{accounts.digest}'.encode()).hexdigest()
 
-            if stock not in corps:
-                continue
 
-            c = corps[stock]
-            try:
-                c.price = int(data[4].strip().replace('"', ''))
-                c.shares = int(data[-1].strip().replace('"', ''))
-            except ValueError:
-                traceback.print_stack()
-                print('Invalid', filename, c.name, data)
-                continue
+def _current(cache) -> bool:
+    # Written by this version with the current fields and account mapping
+    return (int(cache['version']) == _cache_version and list(cache['fields']) == corp.fields
+            and 'taxonomy' in cache.files and str(cache['taxonomy']) == accounts.digest)
 
 
-def get_filename(year, quarter, type, c):
-    cs = '-c' if c else ''
-    filename = f'{year}-{quarter}Q-{type}{cs}.txt'
-    return filename
+def _read_cache_signature(cache) -> Dict[str, tuple]:
+    return {str(n): (int(s), int(m), str(h)) for n, s, m, h in zip(cache['src_name'], cache['src_size'], cache['src_mtime'], cache['src_hash'])}
 
 
-def _load_data(corps, year, quarter, type, c=False):
-    if type == 'PL':    _load_pl(year, quarter, False, c, corps)
-    if type == 'CPL':   _load_pl(year, quarter, True, c, corps)
-    if type == 'CF':    _load_cf(year, quarter, c, corps)
-    if type == 'BS':    _load_bs(year, quarter, c, corps)
-    if type == 'CE':    _load_ce(year, quarter, c, corps)
+def save_cache(year: int, quarter: int, corps: CorpBatch, sig: Dict[str, tuple]) -> None:
+    os.makedirs(_cache_dir, exist_ok=True)
+    arrays = {
+        'version': np.array(_cache_version),
+        'fields': np.array(corp.fields, dtype=str),
+        'taxonomy': np.array(accounts.digest),
+        'values': corps.values[:, :len(corps)],
+        'stock': np.array(corps.stock, dtype=str),
+        'name': np.array(corps.name, dtype=str),
+        'market': np.array([m.value for m in corps.market], dtype=str),
+        'src_name': np.array(list(sig.keys()), dtype=str),
+        'src_size': np.array([v[0] for v in sig.values()], dtype=np.int64),
+        'src_mtime': np.array([v[1] for v in sig.values()], dtype=np.int64),
+        'src_hash': np.array([v[2] for v in sig.values()], dtype=str),
+    }
+    quality = corps.quality()
+    for c in corp.issue_columns:
+        arrays['issue_' + c] = quality[c].fillna('').to_numpy().astype(str)
 
+    filename = _cache_filename(year, quarter)
+    with open(filename + '.tmp', 'wb') as fout:
+        np.savez(fout, **arrays)
+    os.replace(filename + '.tmp', filename)
 
-def data_exists(year: int, quarter: int) -> bool:
-    ret = True
-    types = ['PL', 'CPL', 'CF', 'BS', 'CE']
-    for t in types:
-        ret = ret and os.path.exists('dart-data/' + get_filename(year, quarter, t, False))
-        ret = ret and os.path.exists('dart-data/' + get_filename(year, quarter, t, True))
-    return ret
-    
 
-def load_dart_data(year: int, quarter: int) -> List[Corp]:
-    corps           : Dict[str, Corp] = {}
+def load_cache(year: int, quarter: int, entries: Dict[str, catalog.Entry] = None) -> CorpBatch:
+    filename = _cache_filename(year, quarter)
+    if not os.path.exists(filename):
+        return None
 
-    '''
-    cache_filename = _cache_filename(year, quarter)
     try:
-        if os.path.exists(cache_filename):
-            with open(cache_filename, 'r', encoding='utf-8') as fin:
-                return json.load(fin)
-    except Exception as ex:
-        print(ex)
-    '''
+        with np.load(filename, allow_pickle=False) as cache:
+            if not _current(cache):
+                return None
+            known = _read_cache_signature(cache)
+            if known.keys() != set(catalog.source_files(year, quarter)):
+                return None
+            sig = source_signature(year, quarter, entries)
+            if any(sig[f][0] != known[f][0] or sig[f][2] != known[f][2] for f in sig):
+                return None
+
+            issues = pd.DataFrame({c: cache['issue_' + c].astype(object) for c in corp.issue_columns})
+            issues = issues.where(issues != '', None)
+            corps = CorpBatch.from_arrays(year, quarter, cache['stock'].tolist(), cache['name'].tolist(), cache['market'].tolist(), cache['values'], issues)
+    except (OSError, KeyError, ValueError) as ex:
+        print(f'Invalid cache {filename}: {ex}')
+        return None
+
+    # Files were touched but not edited
+    if sig != known:
+        save_cache(year, quarter, corps, sig)
+    return corps
+
+
+def cache_status() -> List[Dict]:
+    ret = []
+    if not os.path.exists(_cache_dir):
+        return ret
+    entries = catalog.scan()
+    for f in sorted(os.listdir(_cache_dir)):
+        m = re.fullmatch(r'(\d{4})-(\d)Q\.npz', f)
+        if m is None:
+            continue
+        year, quarter = int(m.group(1)), int(m.group(2))
+        status = 'stale'
+        try:
+            with np.load(f'{_cache_dir}/{f}', allow_pickle=False) as cache:
+                corps = len(cache['stock'])
+                if _current(cache) and catalog.complete(entries, year, quarter):
+                    known = _read_cache_signature(cache)
+                    if known.keys() == set(catalog.source_files(year, quarter)):
+                        sig = source_signature(year, quarter, entries)
+                        if all(sig[k][0] == known[k][0] and sig[k][2] == known[k][2] for k in sig):
+                            status = 'valid'
+        except (OSError, KeyError, ValueError):
+            corps = 0
+            status = 'invalid'
+        ret.append({'year': year, 'quarter': quarter, 'corps': corps, 'bytes': os.path.getsize(f'{_cache_dir}/{f}'), 'status': status})
+    return ret
+
+
+def purge_cache(year: int = None, quarter: int = None) -> int:
+    count = 0
+    for c in cache_status():
+        if year is not None and c['year'] != year:
+            continue
+        if quarter is not None and c['quarter'] != quarter:
+            continue
+        os.remove(_cache_filename(c['year'], c['quarter']))
+        count += 1
+    return count
+
+
+def load_dart_data(year: int, quarter: int, use_cache: bool = True) -> CorpBatch:
+    corps = CorpBatch(year, quarter)
+
+    if use_cache:
+        entries = catalog.scan()
+        cached = load_cache(year, quarter, entries)
+        if cached is not None:
+            return cached
 
     try:
-        # 손익계산서(연결)
-        _load_data(corps, year, quarter, 'PL', False)    
-        _load_data(corps, year, quarter, 'PL', True)
-
-        # 포괄손익계산서(연결)
-        _load_data(corps, year, quarter, 'CPL', False)    
-        _load_data(corps, year, quarter, 'CPL', True)
-        
-        # 현금흐름표(연결)
-        _load_data(corps, year, quarter, 'CF', False)    
-        _load_data(corps, year, quarter, 'CF', True)
-
-        # 재무상태표(연결)
-        _load_data(corps, year, quarter, 'BS', False)
-        _load_data(corps, year, quarter, 'BS', True)
-
-        # 자본변동
-        _load_data(corps, year, quarter, 'CE', False)
-        _load_data(corps, year, quarter, 'CE', True)
+        # Signature is taken before parsing so that a file edited meanwhile invalidates the cache
+        sig = source_signature(year, quarter, entries) if use_cache else None
+
+        # 손익계산서, 포괄손익계산서, 현금흐름표, 재무상태표, 자본변동표 (연결)
+        # A file that cannot be parsed is recorded as an issue and only its rows are missing
+        for type, con in statement_files:
+            try:
+                parsed = parse_statement(year, quarter, type, con)
+            except Exception as ex:
+                corps.add_issues(unreadable(get_filename(year, quarter, type, con), f'{ex.__class__.__name__}: {ex}'))
+                continue
+            merge_statement(corps, type, parsed)
 
         # 시가총액, 상장주식수
-        filename = f'{year}-{quarter}Q-Stocks.csv'
-        _load_shares(filename, corps)
-
-        '''
-        with open(f'{year}-{quarter}.log', 'w', encoding='utf-8') as fout:
-            for corp in corps.values():
-                asdict = corp.__dict__
-                valid = True
-                # print(asdict)
-                for v in asdict.values():
-                    if v is None:
-                        valid = False
-                if not valid:
-                    corps_invalid[corp.stock] = corp
-                    
-                    delkeys = []
-                    for k in asdict.keys():
-                        if k != 'name' and asdict[k] is not None:
-                            delkeys.append(k)                            
-                    for k in delkeys:
-                        del asdict[k]
-                    
-                    log = json.dumps(asdict, indent=4, ensure_ascii=False)
-                    # print(log)
-                    fout.write(log)
-                    pass
-                
-        for stock in corps_invalid:
-            del corps[stock]
-        # print(f'Invalid: {year} {quarter}Q {len(corps_invalid)}')
-
-        #for c in ret:
-        #    c.cal_indicators()
-        '''
-
-        ret = list(corps.values())
-        return ret
+        try:
+            parsed = parse_shares(year, quarter)
+        except Exception as ex:
+            corps.add_issues(unreadable(f'{year}-{quarter}Q-Stocks.csv', f'{ex.__class__.__name__}: {ex}'))
+        else:
+            merge_shares(corps, parsed)
+
+        if use_cache:
+            save_cache(year, quarter, corps, sig)
+        return corps
     except Exception as ex:
         # traceback.print_stack()
         # print(ex)
@@ -352,6 +498,16 @@ def load_dart_data(year: int, quarter: int) -> List[Corp]:
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--cache':
+        # krx.py --cache [purge [year [quarter]]]
+        if len(sys.argv) > 2 and sys.argv[2] == 'purge':
+            args = [int(a) for a in sys.argv[3:5]]
+            print(f'Removed {purge_cache(*args)} cached quarters')
+        else:
+            for c in cache_status():
+                print(f"{c['year']}-{c['quarter']}Q  {c['corps']:5d} corps  {c['bytes']:10d} bytes  {c['status']}")
+        sys.exit()
+
     for year in range(2016, 2021):
         for quarter in range(1, 5):
             corps = load_dart_data(year, quarter)
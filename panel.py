@@ -0,0 +1,197 @@
+from __future__ import annotations
+from typing import Dict, List, Tuple
+import hashlib
+import shutil, sqlite3
+
+import numpy as np
+import pandas as pd
+
+import accounts
+import schema
+import store
+
+
+# Standalone-quarter and trailing-twelve-month flows over a (stock x quarter) panel.
+# 1Q-3Q reports have PL amounts of the quarter and 4Q reports of the whole year, CF amounts are from the
+# beginning of the year in every report. {field}_q is the amount of the quarter alone, the year to date less
+# that of the previous quarter. {field}_ttm is the amount of the last four quarters, ytd + prior_fy - prior_ytd
+# of the same report, or the sum of the last four standalone quarters when the report lacks those columns.
+flows = [a[0] for a in accounts.taxonomy if set(a[1]) & {'PL', 'CPL', 'CF'}]
+
+# Flows whose current amount is already the quarter's in 1Q-3Q
+_quarterly = {a[0] for a in accounts.taxonomy if set(a[1]) <= {'PL', 'CPL'}}
+
+# Quarters before the derived ones needed by derive()
+history = 4
+
+money_columns = [f'{f}_{s}' for f in flows for s in ('q', 'ttm')] + ['fcf_ttm']
+ratio_columns = ['per_ttm', 'psr_ttm', 'pcr_ttm', 'pfcr_ttm', 'iper_ttm', 'ipsr_ttm', 'ipcr_ttm', 'ipfcr_ttm', 'roe_ttm', 'roa_ttm']
+columns = money_columns + ratio_columns
+
+# Columns of the krx table read by derive()
+inputs = ['stock', 'year', 'quarter', 'market_cap', 'equity', 'assets'] + [f'{f}{p}' for f in flows for p in ('', '_ytd', '_prior_ytd', '_prior_fy')]
+
+
+def _shift(a: np.ndarray, n: int) -> np.ndarray:
+    # Values of n quarters before, NaN before the first quarter of the panel
+    n = min(n, a.shape[1])
+    return np.concatenate([np.full((a.shape[0], n), np.nan), a[:, :a.shape[1] - n]], axis=1)
+
+
+def derive(df: pd.DataFrame) -> pd.DataFrame:
+    # df has the inputs columns, one row per stock and quarter. Returns the derived columns, in the rows of df.
+    # Quarters missing from df are gaps in the panel: flows depending on them are NaN.
+    stocks, row = np.unique(df['stock'].to_numpy(dtype=str), return_inverse=True)
+    k = df['year'].to_numpy(dtype=np.int64) * 4 + df['quarter'].to_numpy(dtype=np.int64) - 1
+    col = k - k.min()
+    shape = (len(stocks), int(col.max()) + 1 if len(col) > 0 else 0)
+    quarter = (k.min() + np.arange(shape[1])) % 4 + 1 if len(col) > 0 else np.zeros(0, dtype=np.int64)
+    present = np.zeros(shape, dtype=bool)
+    present[row, col] = True
+
+    def grid(name: str, default: float = None) -> np.ndarray:
+        a = np.full(shape, np.nan)
+        a[row, col] = df[name].to_numpy(dtype=np.float64)
+        if default is not None:
+            # Accounts not reported by a corporation, as for its current amount
+            a[present & np.isnan(a)] = default
+        return a
+
+    out = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for f in flows:
+            default = accounts.defaults.get(f)
+            value, ytd = grid(f, default), grid(f'{f}_ytd', default)
+            # The current amount is the year to date in 1Q, 4Q and CF reports
+            cumulative = (quarter == 1) | (quarter == 4) | (f not in _quarterly)
+            ytd = np.where(np.isnan(ytd) & cumulative, value, ytd)
+            previous = np.where(quarter == 1, 0, _shift(ytd, 1))
+            standalone = ytd - previous
+            if f in _quarterly:
+                standalone = np.where(quarter < 4, value, standalone)
+            ttm = ytd + grid(f'{f}_prior_fy', default) - grid(f'{f}_prior_ytd', default)
+            ttm = np.where(np.isnan(ttm) & (quarter == 4), ytd, ttm)
+            rolling = standalone + _shift(standalone, 1) + _shift(standalone, 2) + _shift(standalone, 3)
+            out[f'{f}_q'] = standalone
+            out[f'{f}_ttm'] = np.where(np.isnan(ttm), rolling, ttm)
+
+        market_cap = grid('market_cap')
+        out['fcf_ttm'] = out['cash_flow_ttm'] - out['capex_intangible_ttm'] - out['capex_property_ttm']
+        out['per_ttm'] = market_cap / out['net_income_ttm']
+        out['psr_ttm'] = market_cap / out['sales_ttm']
+        out['pcr_ttm'] = market_cap / out['cash_flow_ttm']
+        out['pfcr_ttm'] = market_cap / out['fcf_ttm']
+        out['iper_ttm'] = 1 / out['per_ttm']
+        out['ipsr_ttm'] = 1 / out['psr_ttm']
+        out['ipcr_ttm'] = 1 / out['pcr_ttm']
+        out['ipfcr_ttm'] = 1 / out['pfcr_ttm']
+        out['roe_ttm'] = out['net_income_ttm'] / grid('equity')
+        out['roa_ttm'] = out['net_income_ttm'] / grid('assets')
+
+    return pd.DataFrame({c: out[c][row, col] for c in columns}, index=df.index)
+
+
+
+# Dense panel of the krx table: values[field, stock, quarter] (integers are exact up to 2**53) kept in {path}
+# by store.write, with the fields, stocks and quarters in its index.
+# Stocks are sorted by code and quarters are consecutive, so the previous quarter of column i is column i - 1.
+_panel_dir = 'halq-panel'
+_panel_version = 1
+_table_name = schema.table_name
+_build_table = schema.build_table
+
+
+class Panel:
+    def __init__(self, values: np.ndarray, fields: List[str], stocks: List[str], quarters: List[Tuple[int, int]], signature: str = None):
+        self.values = values
+        self.fields = fields
+        self.stocks = stocks
+        self.quarters = quarters
+        self.signature = signature
+        self.field_index: Dict[str, int] = {f: i for i, f in enumerate(fields)}
+        self.stock_index: Dict[str, int] = {s: i for i, s in enumerate(stocks)}
+        self.quarter_index: Dict[Tuple[int, int], int] = {t: i for i, t in enumerate(quarters)}
+
+    def get(self, stock: str, year: int, quarter: int, field: str) -> float:
+        return self.values[self.field_index[field], self.stock_index[stock], self.quarter_index[(year, quarter)]]
+
+    def field(self, name: str) -> np.ndarray:
+        # stock x quarter matrix, a view of the mapped file
+        return self.values[self.field_index[name]]
+
+    def row(self, stock: str, year: int, quarter: int) -> pd.Series:
+        return pd.Series(self.values[:, self.stock_index[stock], self.quarter_index[(year, quarter)]], index=self.fields)
+
+    def frame(self, name: str) -> pd.DataFrame:
+        return pd.DataFrame(self.field(name), index=self.stocks, columns=pd.MultiIndex.from_tuples(self.quarters, names=['year', 'quarter']))
+
+    def lag(self, name: str, n: int = 1) -> np.ndarray:
+        # Values n quarters before (4 for the same quarter of the previous year)
+        return _shift(self.field(name), n)
+
+    def growth(self, name: str, n: int = 1) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            previous = self.lag(name, n)
+            return (self.field(name) - previous) / previous
+
+    def rank(self, name: str = None, descending: bool = True, values: np.ndarray = None) -> np.ndarray:
+        # Rank 1..n of each stock within its quarter, ties broken by stock code, missing values NaN,
+        # as convert_sqlite.rank_corps(nulls='null'). values: a stock x quarter matrix instead of a field.
+        a = self.field(name) if values is None else values
+        key = np.where(np.isnan(a), np.inf, -a if descending else a)
+        order = np.argsort(key, axis=0, kind='stable')
+        ranks = np.empty(a.shape)
+        np.put_along_axis(ranks, order, np.broadcast_to(np.arange(1, a.shape[0] + 1, dtype=np.float64)[:, None], a.shape), axis=0)
+        ranks[np.isnan(a)] = np.nan
+        return ranks
+
+
+def _signature(conn: sqlite3.Connection) -> str:
+    # Digest of the quarters built into halq.db, changes with every build
+    h = hashlib.sha1()
+    for r in conn.execute(f'SELECT year, quarter, signature, built_at FROM {_build_table} ORDER BY year, quarter'):
+        h.update(repr(tuple(r)).encode())
+    return h.hexdigest()
+
+
+def _numeric_columns(conn: sqlite3.Connection) -> List[str]:
+    return [r[1] for r in conn.execute(f'PRAGMA table_info({_table_name})') if r[2].upper() in ('INTEGER', 'REAL') and r[1] not in ('index', 'year', 'quarter')]
+
+
+def build(conn: sqlite3.Connection, path: str = _panel_dir, chunksize: int = 100000) -> Panel:
+    # Writes every numeric column of the krx table into {path}, replacing the files atomically
+    fields = _numeric_columns(conn)
+    stocks = [r[0] for r in conn.execute(f'SELECT DISTINCT stock FROM {_table_name} ORDER BY stock')]
+    first, last = conn.execute(f'SELECT MIN(year*4+quarter-1), MAX(year*4+quarter-1) FROM {_table_name}').fetchone()
+    quarters = [] if first is None else [(k // 4, k % 4 + 1) for k in range(first, last + 1)]
+    stock_index = {s: i for i, s in enumerate(stocks)}
+
+    def fill(values: np.ndarray) -> None:
+        # Rows are scattered a chunk at a time, the table is never held in memory as a whole
+        sql = f'SELECT stock, year*4+quarter-1 AS k, {", ".join(fields)} FROM {_table_name}'
+        for df in pd.read_sql_query(sql, conn, chunksize=chunksize):
+            row = df['stock'].map(stock_index).to_numpy()
+            col = df['k'].to_numpy() - first
+            values[:, row, col] = df[fields].to_numpy(dtype=np.float64).T
+
+    store.write(path, _panel_version, _signature(conn), (len(fields), len(stocks), len(quarters)), fill,
+                {'fields': fields, 'stocks': stocks, 'quarters': quarters})
+    return load(path)
+
+
+def load(path: str = _panel_dir) -> Panel:
+    # Memory-mapped read-only, None if there is no panel
+    loaded = store.load(path, _panel_version)
+    if loaded is None:
+        return None
+    values, index = loaded
+    return Panel(values, index['fields'], index['stocks'], [tuple(t) for t in index['quarters']], index['signature'])
+
+
+def up_to_date(conn: sqlite3.Connection, path: str = _panel_dir) -> bool:
+    p = load(path)
+    return p is not None and p.signature == _signature(conn) and p.fields == _numeric_columns(conn)
+
+
+def remove(path: str = _panel_dir) -> None:
+    shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,192 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+import argparse
+import hashlib
+import os, re
+
+import numpy as np
+import pandas as pd
+
+import archive
+import backtest
+import ingest
+import krx
+import panel
+import store
+
+
+# Daily prices of KRX stock files, {_data_dir}/{yyyymmdd}-Stocks.csv in the layout of the quarterly Stocks.csv,
+# kept as a dense values[field, stock, day] array like panel.Panel, in {path} by store.write with the stocks, the
+# trading days and the files ingested in its index. update() parses only the files added or changed since the last run.
+#
+# Market cap and valuation ratios of any day against the latest financials published by then:
+#
+#   p = prices.update()
+#   days, v = prices.valuation(p, backtest.load()[0], begin='2021-01-01')     # v['per']: stock x day
+_data_dir = 'dart-data/prices'
+_prices_dir = 'halq-prices'
+_prices_version = 1
+_daily = re.compile(r'(\d{8})-Stocks\.csv')
+
+fields = ['price', 'shares', 'market']
+
+# Days after the end of a quarter by which its reports are filed: 45 for quarterly and half-year reports, 90 for annual ones
+_filing_days = {1: 45, 2: 45, 3: 45, 4: 90}
+
+# Quarters a stock's financials are carried over when its latest report is missing
+_carry = 4
+
+# (name, financial field of the panel) of the ratios of valuation(), the inverses are i{name}
+_ratios = [('per', 'net_income_ttm'), ('pbr', 'book_value'), ('psr', 'sales_ttm'), ('pcr', 'cash_flow_ttm'), ('pfcr', 'fcf_ttm')]
+
+
+class Prices:
+    def __init__(self, values: np.ndarray, stocks: List[str], days: np.ndarray, files: Dict[str, list], signature: str = None):
+        self.values = values
+        self.stocks = stocks
+        self.days = days                # datetime64[D], increasing
+        self.files = files              # name -> [size, mtime_ns]
+        self.signature = signature
+        self.stock_index: Dict[str, int] = {s: i for i, s in enumerate(stocks)}
+
+    def field(self, name: str) -> np.ndarray:
+        # stock x day matrix, a view of the mapped file. market holds the codes of backtest.market_codes, NaN if not traded.
+        return self.values[fields.index(name)]
+
+    def day(self, day) -> int:
+        # Column of the last trading day on or before day, -1 before the first
+        return int(np.searchsorted(self.days, np.datetime64(day, 'D'), side='right')) - 1
+
+    def get(self, stock: str, day, field: str = 'price') -> float:
+        # As of day: the value of the last trading day on or before it
+        i = self.day(day)
+        return np.nan if i < 0 else float(self.field(field)[self.stock_index[stock], i])
+
+    def market_cap(self, columns=slice(None)) -> np.ndarray:
+        return self.field('price')[:, columns] * self.field('shares')[:, columns]
+
+    def frame(self, name: str) -> pd.DataFrame:
+        return pd.DataFrame(self.field(name), index=self.stocks, columns=pd.DatetimeIndex(self.days, name='day'))
+
+
+def published(year: int, quarter: int) -> np.datetime64:
+    # Day by which the reports of a quarter are filed
+    end = (np.datetime64(f'{year}-{quarter * 3:02d}', 'M') + 1).astype('datetime64[D]') - 1
+    return end + _filing_days[quarter]
+
+
+def valuation(prices: Prices, p: panel.Panel, begin=None, end=None) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    # Trading days in [begin, end] and stock x day matrices of market_cap and the _ratios, each day against the
+    # financials of the latest quarter published on or before it (see published) in the panel of halq.db
+    first = 0 if begin is None else int(np.searchsorted(prices.days, np.datetime64(begin, 'D')))
+    last = len(prices.days) if end is None else prices.day(end) + 1
+    days = prices.days[first:last]
+    quarter = np.searchsorted(np.array([published(*t) for t in p.quarters], dtype='datetime64[D]'), days, side='right') - 1
+
+    rows = np.array([p.stock_index.get(s, -1) for s in prices.stocks], dtype=np.int64)
+    found, dated = rows >= 0, quarter >= 0
+
+    def financial(name: str) -> np.ndarray:
+        a = np.full((len(prices.stocks), len(days)), np.nan)
+        carried = pd.DataFrame(p.field(name)).ffill(axis=1, limit=_carry).to_numpy()
+        a[np.ix_(found, dated)] = carried[np.ix_(rows[found], quarter[dated])]
+        return a
+
+    market_cap = prices.market_cap(slice(first, last))
+    ret = {'market_cap': market_cap}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name, field in _ratios:
+            ret[name] = market_cap / financial(field)
+            ret[f'i{name}'] = 1 / ret[name]
+    return days, ret
+
+
+def _parse(task: Tuple[str, str]) -> Tuple[str, pd.DataFrame]:
+    dir, name = task
+    with open(os.path.join(dir, name), 'rb') as fin:
+        df, _ = krx.read_stocks(archive.decode(fin.read()), name)
+    return name, df
+
+
+def _files(dir: str) -> Dict[str, list]:
+    if not os.path.isdir(dir):
+        return {}
+    ret = {}
+    with os.scandir(dir) as it:
+        for e in it:
+            if _daily.fullmatch(e.name):
+                st = e.stat()
+                ret[e.name] = [st.st_size, st.st_mtime_ns]
+    return ret
+
+
+def _day(name: str) -> np.datetime64:
+    d = _daily.fullmatch(name).group(1)
+    return np.datetime64(f'{d[:4]}-{d[4:6]}-{d[6:]}', 'D')
+
+
+def update(dir: str = _data_dir, path: str = _prices_dir, workers: int = None) -> Prices:
+    # Prices of every daily file in dir, parsing only those added or changed since the last run
+    old = load(path)
+    files = _files(dir)
+    known = {} if old is None else old.files
+    changed = sorted(n for n, st in files.items() if known.get(n) != st)
+    if old is not None and len(changed) == 0 and set(known) == set(files):
+        return old
+
+    tasks = [(dir, n) for n in changed]
+    workers = min(ingest.default_workers() if workers is None else workers, len(tasks))
+    if workers > 1:
+        # A worker that dies breaks the pool and map raises
+        with ProcessPoolExecutor(workers) as pool:
+            parsed = list(pool.map(_parse, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+    else:
+        parsed = [_parse(t) for t in tasks]
+    print(f'Parsed {len(parsed)} daily files of {dir}')
+
+    # Days of files removed or re-read are dropped from the previous array
+    kept = np.zeros(0, dtype=np.int64) if old is None else np.flatnonzero(np.isin(old.days, [_day(n) for n in files if n not in changed]))
+    days = np.unique(np.concatenate([old.days[kept] if old is not None else np.zeros(0, dtype='datetime64[D]'),
+                                     np.array([_day(n) for n, _ in parsed], dtype='datetime64[D]')]))
+    stocks = sorted((set(old.stocks) if old is not None else set()) | {s for _, df in parsed for s in df['stock']})
+    stock_index = {s: i for i, s in enumerate(stocks)}
+
+    def fill(values: np.ndarray) -> None:
+        if old is not None and len(kept) > 0:
+            rows = np.array([stock_index[s] for s in old.stocks], dtype=np.int64)
+            cols = np.searchsorted(days, old.days[kept])
+            # A field at a time, the old array is not read into memory as a whole
+            for i in range(len(fields)):
+                values[i][np.ix_(rows, cols)] = old.values[i][:, kept]
+        for name, df in parsed:
+            rows = df['stock'].map(stock_index).to_numpy()
+            col = int(np.searchsorted(days, _day(name)))
+            values[:, rows, col] = np.array([df['price'].to_numpy(), df['shares'].to_numpy(),
+                                             df['market'].map(backtest.market_codes).to_numpy(dtype=np.float64)])
+
+    signature = hashlib.sha1(repr(sorted(files.items())).encode()).hexdigest()
+    store.write(path, _prices_version, signature, (len(fields), len(stocks), len(days)), fill,
+                {'stocks': stocks, 'days': [str(d) for d in days], 'files': files})
+    return load(path)
+
+
+def load(path: str = _prices_dir) -> Prices:
+    # Memory-mapped read-only, None if nothing was ingested
+    loaded = store.load(path, _prices_version)
+    if loaded is None:
+        return None
+    values, index = loaded
+    return Prices(values, index['stocks'], np.array(index['days'], dtype='datetime64[D]'), index['files'], index['signature'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest daily KRX stock files into halq-prices')
+    parser.add_argument('--dir', default=_data_dir, help='directory of {yyyymmdd}-Stocks.csv files')
+    parser.add_argument('--path', default=_prices_dir)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    p = update(args.dir, args.path, args.workers)
+    if p is None or len(p.days) == 0:
+        print(f'No daily files in {args.dir}')
+    else:
+        print(f'{len(p.stocks)} stocks, {len(p.days)} days from {p.days[0]} to {p.days[-1]}')
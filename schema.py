@@ -0,0 +1,28 @@
+from typing import Callable, Dict, Sequence, Union
+
+import numpy as np
+
+
+# Names of halq.db shared by convert_sqlite, which builds it, and the modules reading it
+sqlite_filename = 'halq.db'
+table_name = 'krx'
+build_table = 'build_quarters'
+aggregate_table = 'aggregates'
+rank_index = 'index_rank'
+
+# Rank columns (1 is the best) summed into the score, or {column: weight}. Lower scores come first.
+Ranks = Union[Sequence[str], Dict[str, float]]
+
+
+def weights(ranks: Ranks) -> Dict[str, float]:
+    return dict(ranks) if isinstance(ranks, dict) else {col: 1 for col in ranks}
+
+
+def score(ranks: Ranks, column: Callable[[str], np.ndarray]) -> np.ndarray:
+    # Score of the values column(name) of the rank columns, NaN where any of them is
+    return np.sum([np.asarray(column(col), dtype=np.float64) * w for col, w in weights(ranks).items()], axis=0)
+
+
+def score_sql(ranks: Ranks) -> str:
+    # The same score as an SQL expression, NULL where any of the columns is
+    return ' + '.join(col if w == 1 else f'{col}*{float(w)!r}' for col, w in weights(ranks).items())
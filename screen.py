@@ -0,0 +1,200 @@
+from collections import OrderedDict
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+import os, sqlite3, threading
+
+import pandas as pd
+
+import schema
+
+
+# Composite screens over halq.db, e.g. the top 30 of each market by ord_iper + ord_ipbr + ord_profit_growth_qoq
+# among corporations with fscore_k >= 2:
+#
+#   screen.screen(2021, 3, ['ord_iper', 'ord_ipbr', 'ord_profit_growth_qoq'], where=[('fscore_k', '>=', 2)], by_market=True)
+#
+# Statements are parameterized, so each distinct screen is prepared once per connection, and read index_rank
+# (see convert_sqlite) without touching the table when every column they use is in it.
+# Results are cached by screen and database version: a commit to halq.db or a rebuilt file invalidates them.
+#
+# Cross-sectional statistics of each (year, quarter, market) kept by convert_sqlite.prep, and values relative to
+# those of their market:
+#
+#   screen.aggregates(2021, 3, fields=['per', 'roe'])
+#   screen.relative(2021, 3, ['per', 'pbr'])        # per, per_z (z-score), per_rel (value / median), ...
+_sqlite_filename = schema.sqlite_filename
+_table_name = schema.table_name
+_rank_index = schema.rank_index
+_aggregate_table = schema.aggregate_table
+
+_operators = {'=', '!=', '<', '<=', '>', '>=', 'IS', 'IS NOT'}
+
+# Columns of every result
+_key_columns = ['stock', 'name', 'market']
+
+Condition = Tuple[str, str, Union[int, float, str, None]]
+
+
+class Screener:
+    def __init__(self, filename: str = _sqlite_filename, cache_size: int = 256):
+        self.filename = filename
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[tuple, pd.DataFrame]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._file = None
+        self.hits = self.misses = 0
+
+    def _open(self) -> None:
+        # Read-only, shared by threads under self._lock
+        if self._conn is not None:
+            self._conn.close()
+        st = os.stat(self.filename)
+        self._conn = sqlite3.connect(f'file:{self.filename}?mode=ro', uri=True, check_same_thread=False, cached_statements=512)
+        self._file = (st.st_ino, st.st_mtime_ns)
+        self._columns = {r[1] for r in self._conn.execute(f'PRAGMA table_info({_table_name})')}
+        index = [r[2] for r in self._conn.execute(f'PRAGMA index_info({_rank_index})')]
+        self._covered = set(index) if len(index) > 0 else None
+
+    def version(self) -> tuple:
+        # Changes when halq.db is replaced (a rebuild renamed into place) or committed to by another connection
+        st = os.stat(self.filename)
+        if self._conn is None or self._file != (st.st_ino, st.st_mtime_ns):
+            self._open()
+        return self._file + (self._conn.execute('PRAGMA data_version').fetchone()[0],)
+
+    def _check(self, columns: Sequence[str]) -> None:
+        # Column names are put into the statement, only those of the table are accepted
+        for col in columns:
+            if col not in self._columns:
+                raise ValueError(f'Unknown column: {col}')
+
+    def _sql(self, ranks: Dict[str, float], where: Sequence[Condition], market: str, by_market: bool,
+             columns: Sequence[str]) -> Tuple[str, list]:
+        conditions, params = ['year=?', 'quarter=?'], []
+        if market is not None:
+            conditions.append('market=?')
+            params.append(market)
+        for col, op, value in where:
+            if op.upper() not in _operators:
+                raise ValueError(f'Unknown operator: {op}')
+            conditions.append(f'{col} {op.upper()} ?')
+            params.append(value)
+
+        used = set(_key_columns) | set(ranks) | set(columns) | {c for c, _, _ in where} | {'year', 'quarter'}
+        indexed = f' INDEXED BY {_rank_index}' if self._covered is not None and used <= self._covered else ''
+        score = schema.score_sql(ranks)
+        select = ', '.join(_key_columns + [c for c in columns if c not in _key_columns])
+        partition = 'PARTITION BY market ' if by_market else ''
+        sql = f'''SELECT * FROM (
+            SELECT {select}, {score} AS score, ROW_NUMBER() OVER ({partition}ORDER BY {score}, stock) AS position
+            FROM {_table_name}{indexed} WHERE {' AND '.join(conditions)} AND {score} IS NOT NULL
+        ) WHERE position <= ? ORDER BY {'market, ' if by_market else ''}position'''
+        return sql, params
+
+    def _query(self, key: tuple, check: Sequence[str], statement: Callable[[], Tuple[str, list]]) -> pd.DataFrame:
+        # Result of the statement, from the cache while the database is unchanged. statement() is called once the
+        # columns are checked, with the connection of the current file.
+        with self._lock:
+            version = self.version()
+            cached = self._cache.get((key, version))
+            if cached is not None:
+                self._cache.move_to_end((key, version))
+                self.hits += 1
+                return cached.copy()
+
+            self._check(check)
+            cur = self._conn.execute(*statement())
+            df = pd.DataFrame(cur.fetchall(), columns=[d[0] for d in cur.description])
+            self.misses += 1
+            self._cache[(key, version)] = df
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return df.copy()
+
+    def screen(self, year: int, quarter: int, ranks: schema.Ranks, where: Sequence[Condition] = (),
+               market: str = None, by_market: bool = False, limit: int = 30, columns: Sequence[str] = ()) -> pd.DataFrame:
+        # ranks: rank columns (1 is the best) summed into the score, or {column: weight}. Lower scores come first.
+        # where: (column, operator, value) conditions, e.g. ('fscore_k', '>=', 2)
+        # market: only 'KOSPI' or 'KOSDAQ', by_market: the top limit of each market
+        # columns: columns returned besides stock, name, market, score and position
+        ranks = schema.weights(ranks)
+        key = ('screen', year, quarter, tuple(ranks.items()), tuple(tuple(w) for w in where), market, by_market, limit, tuple(columns))
+        check = list(ranks) + list(columns) + [c for c, _, _ in where]
+
+        def statement():
+            sql, params = self._sql(ranks, where, market, by_market, columns)
+            return sql, [year, quarter] + params + [limit]
+        return self._query(key, check, statement)
+
+    def aggregates(self, year: int, quarter: int, market: str = None, fields: Sequence[str] = None) -> pd.DataFrame:
+        # count, mean, std, min, p10, p25, median, p75, p90, max of each market and field
+        conditions, params = ['year=?', 'quarter=?'], [year, quarter]
+        if market is not None:
+            conditions.append('market=?')
+            params.append(market)
+        if fields is not None:
+            conditions.append(f'field IN ({", ".join("?" * len(fields))})')
+            params.extend(fields)
+        sql = f'SELECT * FROM {_aggregate_table} WHERE {" AND ".join(conditions)} ORDER BY market, field'
+        return self._query(('aggregates', year, quarter, market, None if fields is None else tuple(fields)), [], lambda: (sql, params))
+
+    def relative(self, year: int, quarter: int, fields: Sequence[str], market: str = None, columns: Sequence[str] = ()) -> pd.DataFrame:
+        # Each field with its z-score within the market ({field}_z) and its ratio to the market median ({field}_rel),
+        # NULL where the statistics are (no values, a single one, a zero median)
+        select, joins = [f'k.{c}' for c in _key_columns + [c for c in columns if c not in _key_columns]], []
+        for i, f in enumerate(fields):
+            a = f'a{i}'
+            select += [f'k.{f}', f'(k.{f} - {a}.mean) / NULLIF({a}.std, 0) AS {f}_z', f'k.{f} / NULLIF({a}.median, 0) AS {f}_rel']
+            joins.append(f'LEFT JOIN {_aggregate_table} {a} ON {a}.year=k.year AND {a}.quarter=k.quarter AND {a}.market=k.market AND {a}.field=?')
+        conditions, params = ['k.year=?', 'k.quarter=?'], list(fields) + [year, quarter]
+        if market is not None:
+            conditions.append('k.market=?')
+            params.append(market)
+        sql = f'SELECT {", ".join(select)} FROM {_table_name} k {" ".join(joins)} WHERE {" AND ".join(conditions)} ORDER BY k.stock'
+        return self._query(('relative', year, quarter, tuple(fields), market, tuple(columns)), list(fields) + list(columns), lambda: (sql, params))
+
+    def explain(self, year: int, quarter: int, ranks: schema.Ranks, where: Sequence[Condition] = (),
+                market: str = None, by_market: bool = False, limit: int = 30, columns: Sequence[str] = ()) -> List[str]:
+        # Query plan of a screen, to check that it reads index_rank
+        ranks = schema.weights(ranks)
+        with self._lock:
+            self.version()
+            self._check(list(ranks) + list(columns) + [c for c, _, _ in where])
+            sql, params = self._sql(ranks, where, market, by_market, columns)
+            return [r[3] for r in self._conn.execute('EXPLAIN QUERY PLAN ' + sql, [year, quarter] + params + [limit])]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._cache.clear()
+
+
+_screeners: Dict[str, Screener] = {}
+
+
+def screener(filename: str = _sqlite_filename) -> Screener:
+    # One Screener, and so one cache, per database file in a process
+    if filename not in _screeners:
+        _screeners[filename] = Screener(filename)
+    return _screeners[filename]
+
+
+def screen(year: int, quarter: int, ranks: schema.Ranks, where: Sequence[Condition] = (),
+           market: str = None, by_market: bool = False, limit: int = 30, columns: Sequence[str] = (),
+           filename: str = _sqlite_filename) -> pd.DataFrame:
+    return screener(filename).screen(year, quarter, ranks, where, market, by_market, limit, columns)
+
+
+def aggregates(year: int, quarter: int, market: str = None, fields: Sequence[str] = None, filename: str = _sqlite_filename) -> pd.DataFrame:
+    return screener(filename).aggregates(year, quarter, market, fields)
+
+
+def relative(year: int, quarter: int, fields: Sequence[str], market: str = None, columns: Sequence[str] = (),
+             filename: str = _sqlite_filename) -> pd.DataFrame:
+    return screener(filename).relative(year, quarter, fields, market, columns)
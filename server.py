@@ -0,0 +1,244 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+import argparse
+import json
+import os, re, sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import schema
+
+
+# Local HTTP/JSON service over the krx table, answered from an in-memory snapshot of halq.db.
+# A thread watches halq.db, loads the new file when a build renames it into place and swaps the snapshot:
+# requests in flight finish with the snapshot they started with.
+#
+#   GET /status                                   version of the snapshot
+#   GET /quarters                                 (year, quarter) in the snapshot
+#   GET /quarter/2021/3?columns=per,pbr&market=KOSPI
+#   GET /rank/2021/3?by=ord_iper,ord_ipbr&where=fscore_k>=2&limit=30&by_market=1
+#   GET /stock/005930?columns=sales,net_income
+#
+#   python server.py --port 8000
+_sqlite_filename = schema.sqlite_filename
+_table_name = schema.table_name
+
+_key_columns = ['stock', 'name', 'market']
+_condition = re.compile(r'(\w+)\s*(>=|<=|!=|=|>|<)\s*(.+)')
+_operators = {'>=': np.greater_equal, '<=': np.less_equal, '!=': np.not_equal, '=': np.equal, '>': np.greater, '<': np.less}
+
+
+class Snapshot:
+    # The krx table as columns sorted by (year, quarter, stock), a quarter is a contiguous slice
+    def __init__(self, filename: str):
+        st = os.stat(filename)
+        conn = sqlite3.connect(f'file:{filename}?mode=ro', uri=True)
+        try:
+            df = pd.read_sql_query(f'SELECT * FROM {_table_name} ORDER BY year, quarter, stock', conn)
+        finally:
+            conn.close()
+        self.version = (st.st_ino, st.st_mtime_ns)
+        self.loaded_at = time.time()
+        self.frame = df.drop(columns=['index'], errors='ignore').reset_index(drop=True)
+        self.columns: Dict[str, np.ndarray] = {c: self.frame[c].to_numpy() for c in self.frame.columns}
+
+        k = self.columns['year'].astype(np.int64) * 4 + self.columns['quarter'].astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]]) if len(k) > 0 else np.zeros(0, dtype=np.int64)
+        ends = np.r_[starts[1:], len(k)]
+        self.quarters: Dict[Tuple[int, int], slice] = {
+            (int(self.columns['year'][s]), int(self.columns['quarter'][s])): slice(int(s), int(e)) for s, e in zip(starts, ends)}
+        self.stocks: Dict[str, np.ndarray] = {s: rows for s, rows in self.frame.groupby('stock').indices.items()}
+
+    def _check(self, columns: List[str]) -> None:
+        for col in columns:
+            if col not in self.columns:
+                raise KeyError(f'Unknown column: {col}')
+
+    def _records(self, rows, columns: List[str]) -> List[Dict]:
+        # NaN becomes null
+        df = self.frame.iloc[rows][columns]
+        return df.astype(object).where(df.notna(), None).to_dict('records')
+
+    def quarter(self, year: int, quarter: int, columns: List[str], market: str = None) -> List[Dict]:
+        self._check(columns)
+        rows = np.arange(len(self.frame))[self.quarters[(year, quarter)]]
+        if market is not None:
+            rows = rows[self.columns['market'][rows] == market]
+        return self._records(rows, _key_columns + [c for c in columns if c not in _key_columns])
+
+    def rank(self, year: int, quarter: int, by: List[str], where: List[Tuple[str, str, float]] = (), market: str = None,
+             by_market: bool = False, limit: int = 30, columns: List[str] = ()) -> List[Dict]:
+        # Lowest sum of the by columns first (ranks, 1 is the best), ties broken by stock code as screen.screen
+        if len(by) == 0:
+            raise ValueError('by: no rank columns')
+        for col in by:
+            if col not in self.columns:
+                raise ValueError(f'by: unknown column {col}')
+        self._check(list(columns) + [c for c, _, _ in where])
+        rows = np.arange(len(self.frame))[self.quarters[(year, quarter)]]
+        keep = np.ones(len(rows), dtype=bool)
+        if market is not None:
+            keep &= self.columns['market'][rows] == market
+        for col, op, value in where:
+            with np.errstate(invalid='ignore'):
+                keep &= _operators[op](self.columns[col][rows].astype(np.float64), value)
+        score = schema.score(by, lambda c: self.columns[c][rows])
+        keep &= ~np.isnan(score)
+        rows, score = rows[keep], score[keep]
+        order = np.lexsort((self.columns['stock'][rows], score))
+        rows, score = rows[order], score[order]
+
+        markets = self.columns['market'][rows]
+        position = np.zeros(len(rows), dtype=np.int64)
+        groups = np.unique(markets) if by_market else [None]
+        for m in groups:
+            mask = markets == m if m is not None else np.ones(len(rows), dtype=bool)
+            position[mask] = np.arange(1, mask.sum() + 1)
+        selected = position <= limit
+        if by_market:
+            selected = np.flatnonzero(selected)[np.lexsort((position[selected], markets[selected]))]
+
+        records = self._records(rows[selected], _key_columns + [c for c in columns if c not in _key_columns])
+        for r, s, p in zip(records, score[selected], position[selected]):
+            r['score'] = float(s)
+            r['position'] = int(p)
+        return records
+
+    def stock(self, stock: str, columns: List[str]) -> List[Dict]:
+        self._check(columns)
+        return self._records(self.stocks[stock], ['year', 'quarter'] + _key_columns + [c for c in columns if c not in _key_columns])
+
+
+class Service:
+    # Holds the current snapshot, replaced as a whole by the watcher
+    def __init__(self, filename: str = _sqlite_filename, interval: float = 2.0):
+        self.filename = filename
+        self.interval = interval
+        self.snapshot = Snapshot(filename)
+        self._stop = threading.Event()
+        self._watcher = threading.Thread(target=self._watch, daemon=True)
+
+    def start(self) -> None:
+        self._watcher.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def reload(self) -> bool:
+        # Loads halq.db if it changed, the previous snapshot stays in use until the new one is complete
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        if (st.st_ino, st.st_mtime_ns) == self.snapshot.version:
+            return False
+        snapshot = Snapshot(self.filename)
+        self.snapshot = snapshot
+        print(f'Loaded {self.filename}: {len(snapshot.frame)} rows, {len(snapshot.quarters)} quarters')
+        return True
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.reload()
+            except Exception as e:
+                print(f'Failed to reload {self.filename}: {type(e).__name__}: {e}')
+
+
+def _columns(query: Dict[str, List[str]], name: str = 'columns') -> List[str]:
+    return [c for v in query.get(name, []) for c in v.split(',') if c != '']
+
+
+def _json(body):
+    # NaN and infinite ratios become null, json.dumps would write them as NaN and Infinity
+    if isinstance(body, float):
+        return body if np.isfinite(body) else None
+    if isinstance(body, dict):
+        return {k: _json(v) for k, v in body.items()}
+    if isinstance(body, (list, tuple)):
+        return [_json(v) for v in body]
+    return body
+
+
+def _conditions(query: Dict[str, List[str]]) -> List[Tuple[str, str, float]]:
+    ret = []
+    for w in query.get('where', []):
+        m = _condition.fullmatch(w.strip())
+        if m is None:
+            raise ValueError(f'Invalid condition: {w}')
+        ret.append((m.group(1), m.group(2), float(m.group(3))))
+    return ret
+
+
+class Handler(BaseHTTPRequestHandler):
+    service: Service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p != '']
+        query = parse_qs(url.query)
+        market = query.get('market', [None])[0]
+        # One snapshot per request, even if it is swapped meanwhile
+        snapshot = self.service.snapshot
+        try:
+            if parts == ['status']:
+                body = {'file': self.service.filename, 'version': list(snapshot.version), 'loaded_at': snapshot.loaded_at,
+                        'rows': len(snapshot.frame), 'quarters': len(snapshot.quarters)}
+            elif parts == ['quarters']:
+                body = [list(t) for t in snapshot.quarters]
+            elif len(parts) == 3 and parts[0] == 'quarter':
+                body = snapshot.quarter(int(parts[1]), int(parts[2]), _columns(query), market)
+            elif len(parts) == 3 and parts[0] == 'rank':
+                body = snapshot.rank(int(parts[1]), int(parts[2]), _columns(query, 'by'), _conditions(query), market,
+                                     query.get('by_market', ['0'])[0] == '1', int(query.get('limit', ['30'])[0]), _columns(query))
+            elif len(parts) == 2 and parts[0] == 'stock':
+                body = snapshot.stock(parts[1], _columns(query))
+            else:
+                return self._send(404, {'error': f'Unknown path: {url.path}'})
+        except KeyError as e:
+            return self._send(404, {'error': f'Not found: {e.args[0]}'})
+        except ValueError as e:
+            return self._send(400, {'error': str(e)})
+        except Exception as e:
+            return self._send(500, {'error': f'{type(e).__name__}: {e}'})
+        self._send(200, body)
+
+    def _send(self, status: int, body) -> None:
+        data = json.dumps(_json(body), ensure_ascii=False, allow_nan=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host: str = '127.0.0.1', port: int = 8000, filename: str = _sqlite_filename, interval: float = 2.0) -> None:
+    service = Service(filename, interval)
+    service.start()
+    Handler.service = service
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    print(f'Serving {filename} on http://{host}:{port}')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        httpd.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local HTTP/JSON service over halq.db')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--db', default=_sqlite_filename)
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between checks for a new build')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.db, args.interval)
@@ -0,0 +1,57 @@
+from typing import Callable, Dict, Tuple
+import json
+import os
+
+import numpy as np
+
+
+# Dense float64 arrays (NaN for missing) derived from halq.db or KRX files, as {path}/values-{signature}.npy and
+# {path}/index.json naming the current file with its version and metadata. Files are written once and then
+# memory-mapped read-only, so processes opening them share the same pages. write() replaces both atomically:
+# readers keep the file they mapped, a process that reads index.json meanwhile gets the old or the new one.
+# The values file of the previous write is kept until the next one, for processes that read its index.json.
+_index_filename = 'index.json'
+
+
+def write(path: str, version: int, signature: str, shape: Tuple[int, ...], fill: Callable[[np.ndarray], None], index: Dict) -> None:
+    # fill(values) sets the values of a new array, initialized to NaN. index is saved with it in index.json.
+    filename = f'values-{signature[:16]}.npy'
+    os.makedirs(path, exist_ok=True)
+    previous = _current(path)
+    tmp = os.path.join(path, filename + '.tmp')
+    values = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float64, shape=shape)
+    values[:] = np.nan
+    fill(values)
+    values.flush()
+    del values
+    os.replace(tmp, os.path.join(path, filename))
+
+    with open(os.path.join(path, _index_filename + '.tmp'), 'w', encoding='utf-8') as fout:
+        json.dump({'version': version, 'signature': signature, 'values': filename, **index}, fout)
+    os.replace(os.path.join(path, _index_filename + '.tmp'), os.path.join(path, _index_filename))
+
+    # Files of older writes, still readable by processes that mapped them
+    for f in os.listdir(path):
+        if f.startswith('values-') and f not in (filename, previous):
+            os.remove(os.path.join(path, f))
+
+
+def _current(path: str) -> str:
+    # Values file named in index.json, None if there is none
+    try:
+        with open(os.path.join(path, _index_filename), 'r', encoding='utf-8') as fin:
+            return json.load(fin)['values']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def load(path: str, version: int) -> Tuple[np.ndarray, Dict]:
+    # (values memory-mapped read-only, index), None if nothing of this version was written
+    try:
+        with open(os.path.join(path, _index_filename), 'r', encoding='utf-8') as fin:
+            index = json.load(fin)
+        if index['version'] != version:
+            return None
+        return np.load(os.path.join(path, index['values']), mmap_mode='r'), index
+    except (OSError, ValueError, KeyError):
+        return None